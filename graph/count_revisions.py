@@ -1,7 +1,9 @@
-import bz2   
 import pickle
 from tqdm import tqdm
-from utils.read_data import groups, parse_line
+from functools import partial
+from utils.read_data import parse_fields
+from utils.parallel_scan import parallel_scan
+from utils.checkpoint import Checkpoint
 import pandas as pd
 import pandas as pd
 import pickle
@@ -17,22 +19,46 @@ output = "/work3/s204163/wiki/wiki-revisions-filtered-length.pickle"
 #WARNING Mannually set, given information from a prior run, used for TQDM to show progress
 N = 7711541
 
-# Converts the bz2 file to a pandas dataframe
-def create_revision_file(filepath, output, tqdm_disable = True) -> pd.DataFrame:
+KEYS = ['article_id', 'revision_id', 'user_id', 'article_title','username','category']
+
+# Converts the bz2 file to a pandas dataframe, chunks of the file are parsed in parallel on all available cores
+# If a checkpoint path is given the parsed chunks are also pickled to it, so a killed job can continue from the last checkpoint
+def create_revision_file(filepath, output, tqdm_disable = True, n_workers = None, checkpoint_path = None) -> pd.DataFrame:
     log_message(f"Beginning to create revision file", output, console_log=True)
-    with bz2.open(filepath, 'rt') as file:
-        revisions = []
-        for index, line in tqdm(enumerate(groups(file, 14)), total = N, disable=tqdm_disable):
-            if index % 100000 == 0:
-                log_message(f"Index: {index} out of {N}, {index/N*100:.2f}%", output, console_log=True)
-            filtered_data = filter_dict_keys(parse_line(line), ['article_id', 'revision_id', 'user_id', 'article_title','username','category'])
-            revisions.append(filtered_data)
-    return pd.DataFrame(revisions)
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+    start = checkpoint.state["revision"] if checkpoint and checkpoint.state else 0
+
+    # The chunks parsed before the last checkpoint
+    revisions = read_partial_chunks(checkpoint.output_path, checkpoint.state["output_size"]) if start else []
+    if start:
+        log_message(f"Resuming from revision {start} with {len(revisions)} revisions", output, console_log=True)
+
+    partial_output = checkpoint.open_output() if checkpoint else None
+    for (_, index), chunk in tqdm(parallel_scan(filepath, partial(parse_chunk, KEYS), n_workers, start = start), disable=tqdm_disable):
+        log_message(f"Index: {index} out of {N}, {index/N*100:.2f}%", output, console_log=True)
+        revisions.extend(chunk)
+
+        if checkpoint:
+            pickle.dump(chunk, partial_output)
+            if checkpoint.due():
+                checkpoint.save({"revision": index}, partial_output)
+
+    if checkpoint:
+        partial_output.close()
+        checkpoint.remove(remove_output=True)
+    return pd.DataFrame(revisions, columns=KEYS)
+
+# Reads the chunks pickled one after another by create_revision_file, up to the size of the last checkpoint
+def read_partial_chunks(path, size) -> list:
+    revisions = []
+    with open(path, "rb") as file:
+        while file.tell() < size:
+            revisions.extend(pickle.load(file))
+    return revisions
 
-# Filters a dictionary by a list of keys
-def filter_dict_keys(dictionary : dict, desired_keys: list[str]):
-    filtered_dict = {key: val for key, val in dictionary.items() if key in desired_keys}
-    return filtered_dict
+# Parses only the desired keys of a chunk of revisions. Runs in a worker process
+def parse_chunk(desired_keys: list[str], lines) -> list[tuple]:
+    return list(parse_fields(lines, desired_keys))
 
 # Divides the whole dataframe into batches and saves them to a directory along with mapping files
 # Such that data can be backtracked given an ID
@@ -96,7 +122,7 @@ if __name__ == '__main__':
     format_date = datetime.now().strftime('%Y-%m-%d.%H:%M')
     output = os.path.join(output_dir, "wiki-revisions-filtered-df.pickle")
     log_file = os.path.join(output_dir, f"count_revision{format_date}.log")
-    df = create_revision_file(filepath, log_file)
+    df = create_revision_file(filepath, log_file, checkpoint_path=os.path.join(output_dir, "count_revisions.checkpoint"))
     df.to_pickle(output)
     create_batches(df, output_dir, log_file, 100000)
         
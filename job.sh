@@ -14,13 +14,13 @@
 #BSUB -q hpc
 
 ### -- ask for number of cores -- 
-#BSUB -n 1
+#BSUB -n 4
 
 ### -- specify that the cores must be on the same host -- 
 #BSUB -R "span[hosts=1]"
 
-### -- specify that we need X GB of memory per core/slot -- 
-#BSUB -R "rusage[mem=5GB]"
+### -- specify that we need X GB of memory per core/slot, 4 x 1250MB = 5GB in total -- 
+#BSUB -R "rusage[mem=1250MB]"
 
 ### -- set walltime limit: hh:mm --
 #BSUB -W 24:00
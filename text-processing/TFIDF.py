@@ -1,81 +1,317 @@
+import csv
+import sys
+import zlib
+import pickle
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
+
 import numpy as np
-import math
 
-from collections import Counter
+from scipy.sparse import csr_matrix
+
+from utils.feature_store import create_array
+from utils.parallel_scan import n_available_cores, imap_bounded
+
+TEXTS_PER_CHUNK = 10_000    # Number of texts counted / transformed at a time by a worker, when fitting out of core
+PENDING_PER_WORKER = 2      # Number of chunks read ahead per worker, so only a few chunks are ever in memory
 
 
 class TFIDF():
-    def __init__(self, max_features=None) -> None:
+    '''
+    TF-IDF with a vocabulary of the max_features words with the highest idf.
+    If n_hash_features is given the hashing trick is used instead: every word is hashed to one of n_hash_features
+    columns, with a random sign so words that collide cancel out instead of adding up, and the document counts are
+    kept per column. The memory is then bounded no matter how many distinct words there are, and texts can be
+    vectorized without fitting a vocabulary first
+    '''
+    def __init__(self, max_features=None, n_hash_features=None) -> None:
         self.max_features = max_features
-        self.tfdic = {}
+        self.n_hash_features = n_hash_features
         self.idfdic = {}
+        self.vocabulary = {}
+        self.idf = np.zeros(0)
+        self._reset()
 
     '''
-    Make a dictionary of term frequencies. Where each document has an index which holds
-    a dictionary of words as keys number of times it is in the text as a value.
-    The value of all words is devided by the value of the most frequent word.
+    Forget the fitted documents. Running counts of the documents are kept, so more documents can be added with
+    partial_fit. A dict of word -> count, or with hashing an array of a count per column
     '''
-    def _term_frequency_dic(self, text:str, idx:int):
-        word_counts = Counter(text.split())
-        max_val = max(word_counts.values())
-        self.tfdic[idx] = {word: count / max_val for word, count in word_counts.items()}
+    def _reset(self):
+        self.doc_count = 0
+        if self.n_hash_features:
+            self.document_counts = np.zeros(self.n_hash_features, dtype=np.int64)
+            self._update_idf()
+        else:
+            self.document_counts = {}
 
-    
     '''
-    Make a dictionary of inverse document frequencies. 
-    Here each key is the set of words of all texts. 
+    Count the words of every text. Every distinct word gets an id (in the order they are first seen) and the
+    counts are returned as arrays of the distinct (text, word id) pairs, sorted by text:
+    rows, word ids, counts, the words of the ids and the number of texts
+    '''
+    def _word_counts(self, texts):
+        split_texts = [text.split() for text in texts]
+        all_words = list(chain.from_iterable(split_texts))
+
+        # Number the words without a python loop over every word, only over the distinct ones
+        words = dict.fromkeys(all_words)
+        for i, word in enumerate(words):
+            words[word] = i
+        ids = np.array(list(map(words.__getitem__, all_words)), dtype=np.int64)
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), [len(text) for text in split_texts])
+
+        n_words = max(len(words), 1)
+        pairs, counts = np.unique(rows * n_words + ids, return_counts=True)
+        return pairs // n_words, pairs % n_words, counts, list(words), len(texts)
+
+    '''
+    The column and sign of every word, -1 for words that arent in the vocabulary.
+    Hashed with crc32 since the builtin hash() is different in every process
+    '''
+    def _columns(self, words):
+        if not self.n_hash_features:
+            columns = np.array([self.vocabulary.get(word, -1) for word in words], dtype=np.int64)
+            return columns, np.ones(len(words), dtype=np.float64)
+
+        hashes = np.array([zlib.crc32(word.encode("utf-8")) for word in words], dtype=np.int64)
+        return hashes % self.n_hash_features, np.where(hashes & 0x80000000, -1.0, 1.0)
+
+    '''
+    Add the documents of the word counts to the running document counts
+    '''
+    def _count_documents(self, word_counts):
+        rows, ids, _, words, doc_count = word_counts
+        self.doc_count += doc_count
+
+        if self.n_hash_features:
+            # A document counts once for a column, even if more of its words hash to it
+            columns, _ = self._columns(words)
+            pairs = np.unique(rows * self.n_hash_features + columns[ids])
+            self.document_counts += np.bincount(pairs % self.n_hash_features, minlength=self.n_hash_features)
+            return
+
+        word_document_counts = np.bincount(ids, minlength=len(words))
+        self._merge_counts(0, dict(zip(words, word_document_counts.tolist())))
+
+    '''
+    Add document counts (of other documents, e.g. counted in a worker) to the running document counts
+    '''
+    def _merge_counts(self, doc_count, document_counts):
+        self.doc_count += doc_count
+        if self.n_hash_features:
+            self.document_counts += document_counts
+            return
+
+        for word, count in document_counts.items():
+            self.document_counts[word] = self.document_counts.get(word, 0) + count
+
+    '''
+    Make a dictionary of inverse document frequencies.
+    Here each key is the set of words of all documents fitted so far.
     The values are the number of time each of the words appear in a document
 
     IDF_i = log2(N/n_i)
     N is the number of documents, n_i is the number of documents the word is in
     We add a 1 to not divide by zero
     '''
-    def _inverse_doc_freq(self, texts):
-        doc_count = len(texts)
+    def _inverse_doc_freq(self):
+        words = list(self.document_counts)
+        word_document_counts = np.array(list(self.document_counts.values()), dtype=np.float64)
+        idf = np.log(1 + self.doc_count) - np.log(1 + word_document_counts) + 1
 
-        word_document_counts = Counter(word for text in texts for word in set(text.split()))
-        self.idfdic = {word: math.log(1 + doc_count) - math.log(1 + df) + 1 for word, df in word_document_counts.items()}
-
-        ### Use only the max number of features
-        if self.max_features is not None:
-            sorted_terms = sorted(self.idfdic.items(), key=lambda x: x[1], reverse=True)
-            self.idfdic = dict(sorted_terms[:self.max_features])
+        ### Use only the max number of features, the highest idf first and the first seen words first on ties
+        terms = np.argsort(-idf, kind='stable')[:self.max_features]
+        self.idfdic = {words[i]: float(idf[i]) for i in terms}
 
     '''
-    Make the dictionaries
-    '''                 
-    def _fit(self, texts):
-        for i, text in enumerate(texts):
-            self._term_frequency_dic(text,i)
-        self._inverse_doc_freq(texts)
-    
+    Make the dictionaries, and the word -> column map. The columns are in sorted order to get the same sequence every time.
+    With hashing every column is a feature, so there is only the idf
+    '''
+    def _update_idf(self):
+        if self.n_hash_features:
+            self.idf = np.log(1 + self.doc_count) - np.log(1 + self.document_counts) + 1
+            return
+
+        self._inverse_doc_freq()
+        self.vocabulary = {word: column for column, word in enumerate(sorted(self.idfdic))}
+        self.idf = np.array([self.idfdic[word] for word in self.vocabulary], dtype=np.float64)
+
     '''
     In order to work with the data, we need to return a matrix.
     In which the texts are TF-IDF vectorized
     TF*IDF
+    The matrix is sparse (CSR), only the words of the vocabulary that are in a text are stored.
+    The term frequency of a word is its count divided by the count of the most frequent word of the text
     '''
-    def _transform(self, texts):
-        ### Sort the set in order to get the same sequence every time
-        all_words = sorted(set(word for text in texts for word in text.split()))
-        tfidf_matrix = []
-        for i, text in enumerate(texts):
-            tfidf_vector = []
-            for word in all_words:
-                if word in self.idfdic:  
-                    tf = self.tfdic[i].get(word,0)
-                    idf = self.idfdic[word]
-                    tfidf_vector.append(tf * idf)
-            tfidf_matrix.append(tfidf_vector)
-        tfidf_matrix = np.array(tfidf_matrix)
+    def _transform(self, word_counts):
+        rows, ids, counts, words, doc_count = word_counts
+
+        # The most frequent word of every text, the pairs are sorted by text so every text is a segment
+        max_counts = np.ones(doc_count, dtype=np.float64)
+        starts = np.searchsorted(rows, np.arange(doc_count))
+        non_empty = np.bincount(rows, minlength=doc_count) > 0
+        if non_empty.any():
+            max_counts[non_empty] = np.maximum.reduceat(counts, starts[non_empty])
+
+        # Keep only the words of the vocabulary, with hashing add up the signed counts of the words of a column
+        column_of_id, sign_of_id = self._columns(words)
+        columns = column_of_id[ids] if len(ids) else ids
+        keep = columns >= 0
+        n_columns = max(len(self.idf), 1)
+        pairs, inverse = np.unique(rows[keep] * n_columns + columns[keep], return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=counts[keep] * sign_of_id[ids[keep]], minlength=len(pairs))
+
+        # Drop the columns where the words cancelled out
+        nonzero = counts != 0
+        rows, columns, counts = pairs[nonzero] // n_columns, pairs[nonzero] % n_columns, counts[nonzero]
+
+        data = counts / max_counts[rows] * self.idf[columns]
+
         ### L2 normalization as per sklearn process
-        l2_norms = np.sqrt((tfidf_matrix ** 2).sum(axis=1, keepdims=True))
+        l2_norms = np.sqrt(np.bincount(rows, weights=data ** 2, minlength=doc_count))
         ### No zero divison
         l2_norms[l2_norms == 0] = 1
-        tfidf_matrix = tfidf_matrix / l2_norms
-        return tfidf_matrix
+        data /= l2_norms[rows]
+
+        # The pairs are sorted by text and then column, i.e. already in CSR order
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=doc_count))])
+        return csr_matrix((data, columns.astype(np.int32), indptr), shape=(doc_count, len(self.idf)))
+
+
+    '''
+    Fit the vocabulary and idf on the texts, forgetting anything fitted before
+    '''
+    def fit(self, texts):
+        self._reset()
+        return self.partial_fit(texts)
+
+    '''
+    Add the texts to the document counts and refresh the vocabulary and idf. Note that the vocabulary (and so the
+    columns) can change, vectors made before are only comparable to new ones after transforming them again.
+    With hashing the columns never change, only the idf
+    '''
+    def partial_fit(self, texts):
+        self._count_documents(self._word_counts(texts))
+        self._update_idf()
+        return self
+
+    '''
+    Vectorize texts with the fitted vocabulary and idf, words that arent in the vocabulary are ignored.
+    With hashing this also works without fitting, every idf is 1 then (i.e. only tf).
+    Returns a sparse CSR matrix (scipy.sparse), or a numpy array if dense
+    '''
+    def transform(self, texts, dense=False):
+        tfidf_matrix = self._transform(self._word_counts(texts))
+        return tfidf_matrix.toarray() if dense else tfidf_matrix
+
+    '''
+    Fit on the texts and vectorize them. Returns a sparse CSR matrix (scipy.sparse), or a numpy array if dense
+    '''
+    def vectorize(self, texts, dense=False):
+        # Count the words once for both fitting and transforming
+        word_counts = self._word_counts(texts)
+        self._reset()
+        self._count_documents(word_counts)
+        self._update_idf()
+        tfidf_matrix = self._transform(word_counts)
+        return tfidf_matrix.toarray() if dense else tfidf_matrix
+
+    '''
+    Fit on chunks of texts without having all of them in memory, e.g. `read_text_chunks(cleaned_texts_path)`.
+    The documents of every chunk are counted on a pool of n_workers processes (all cores by default) and the counts
+    are merged, gives the same model as fit on all the texts at once
+    '''
+    def fit_chunks(self, chunks, n_workers=None):
+        self._reset()
+        n_workers = n_workers or n_available_cores()
+        with Pool(n_workers) as pool:
+            count_chunk = partial(_count_chunk, self.max_features, self.n_hash_features)
+            for doc_count, document_counts in imap_bounded(pool, count_chunk, chunks, PENDING_PER_WORKER * n_workers):
+                self._merge_counts(doc_count, document_counts)
+
+        self._update_idf()
+        return self
+
+    '''
+    Transform chunks of texts and write the rows straight to a feature file (`utils/feature_store.py`) that is
+    memory mapped, so neither the texts nor the matrix have to be in memory. n_rows is the total number of texts.
+    Returns the memory mapped matrix
+    '''
+    def transform_to_file(self, chunks, file_path, n_rows, method="tfidf", id_table_checksum=None, n_workers=None, dtype=np.float32):
+        features = create_array(file_path, (n_rows, len(self.idf)), method, id_table_checksum, dtype)
+
+        row = 0
+        n_workers = n_workers or n_available_cores()
+        with Pool(n_workers, initializer=_init_worker, initargs=(self,)) as pool:
+            for tfidf_matrix in imap_bounded(pool, _transform_chunk, chunks, PENDING_PER_WORKER * n_workers):
+                if n_rows < row + tfidf_matrix.shape[0]:
+                    raise ValueError(f"There are more than n_rows={n_rows} texts")
+                features[row:row + tfidf_matrix.shape[0]] = tfidf_matrix.toarray()
+                row += tfidf_matrix.shape[0]
+
+        if row != n_rows:
+            raise ValueError(f"There are {row} texts, expected n_rows={n_rows}")
+        if isinstance(features, np.memmap):
+            features.flush()
+        return features
+
+    # Saves the fitted model (document counts, vocabulary and idf) to a file
+    def save(self, file_path: str):
+        with open(file_path, "wb") as file:
+            pickle.dump({
+                "max_features": self.max_features,
+                "n_hash_features": self.n_hash_features,
+                "doc_count": self.doc_count,
+                "document_counts": self.document_counts,
+                "vocabulary": self.vocabulary,
+                "idf": self.idf,
+            }, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Loads a model saved with save, so new texts can be transformed without fitting again
+    def load(self, file_path: str):
+        with open(file_path, "rb") as file:
+            model = pickle.load(file)
+
+        self.max_features = model["max_features"]
+        self.n_hash_features = model.get("n_hash_features")
+        self.doc_count = model["doc_count"]
+        self.document_counts = model["document_counts"]
+        self.vocabulary = model["vocabulary"]
+        self.idf = model["idf"]
+        self.idfdic = {word: float(idf) for word, idf in zip(self.vocabulary, self.idf)}
+        return self
+
+
+# The fitted model of a worker process, see `TFIDF.transform_to_file`
+worker_model = None
+
+
+def _init_worker(model: TFIDF) -> None:
+    global worker_model
+    worker_model = model
+
+
+def _count_chunk(max_features, n_hash_features, texts: list) -> tuple:
+    """ Count the documents of a chunk of texts in a worker, returns the number of texts and the document counts """
+    tfidf = TFIDF(max_features, n_hash_features)
+    tfidf._count_documents(tfidf._word_counts(texts))
+    return tfidf.doc_count, tfidf.document_counts
+
 
+def _transform_chunk(texts: list) -> csr_matrix:
+    return worker_model.transform(texts)
 
-    def vectorize(self, texts):
-        self._fit(texts)
-        return self._transform(texts)
 
+def read_text_chunks(file_path: str, chunk_size: int = TEXTS_PER_CHUNK):
+    """ Generator of lists of chunk_size texts of a csv of article id, text (e.g. cleaned_texts), in the order of the file """
+    csv.field_size_limit(sys.maxsize)
+    with open(file_path, 'r', newline='', encoding="utf-8") as file:
+        chunk = []
+        for _, text in csv.reader(file):
+            chunk.append(text)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of the single pass `clean`/`preprocess` against how they used to be done, on a sample of the
+articles. Also checks that both give the same output
+"""
+import re
+import timeit
+
+from preprocessing import clean, preprocess, stemmer, stopwords, stem_cache, punctuation_translator, N_MAX_CHARS
+from utils.read_data import read_articles_file
+
+def old_clean(text: str) -> str:
+    text = re.sub(r'[0-9]', ' ', text)
+    text = text.translate(punctuation_translator)
+    text = text.lower()
+    text = " ".join(text.split())
+    text = text.strip()
+    return text
+
+
+def old_preprocess(text: str, max_chars: int = N_MAX_CHARS) -> str:
+    words = old_clean(text).split()
+    return " ".join([stemmer.stem(word) for word in words if not word in stopwords])[:max_chars]
+
+
+def new_preprocess(text: str) -> str:
+    return preprocess(text, N_MAX_CHARS)
+
+
+def new_preprocess_no_cache(text: str) -> str:
+    """ Every text is stemmed from scratch, like the first chunks of a run without a saved stem cache """
+    stem_cache.clear()
+    return preprocess(text, N_MAX_CHARS)
+
+
+def benchmark(name: str, old, new, texts: list, number: int = 3) -> None:
+    assert [old(text) for text in texts] == [new(text) for text in texts], f"{name}: the outputs are not the same"
+    old_time = min(timeit.repeat(lambda: [old(text) for text in texts], number = 1, repeat = number))
+    new_time = min(timeit.repeat(lambda: [new(text) for text in texts], number = 1, repeat = number))
+    print(f"{name:<22} old: {old_time:.3f}s  new: {new_time:.3f}s  ({old_time / new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    N = 1000
+    texts = list(read_articles_file("/work3/s204163/wiki/article_texts", N = N, read_titles = True).values())
+    print(f"Benchmarking on {len(texts)} articles, {sum(map(len, texts)) / 1e6:.1f}M characters")
+
+    benchmark("clean", old_clean, clean, texts)
+
+    # The stem cache is filled by the first (checking) run, like it would be after the first few chunks of a real run
+    benchmark("preprocess", old_preprocess, new_preprocess, texts)
+    benchmark("preprocess (no cache)", old_preprocess, new_preprocess_no_cache, texts)
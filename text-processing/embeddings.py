@@ -0,0 +1,153 @@
+import os
+import zlib
+import hashlib
+
+import numpy as np
+
+BATCH_SIZE = 64             # Number of texts encoded at a time
+BATCHES_PER_SAVE = 100      # The new vectors are added to the cache every this many batches, so a killed job keeps them
+DIGEST_SIZE = 16            # Bytes of the hash of a text
+
+
+class SBERTEncoder():
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2') -> None:
+        """ Sentence-BERT, what we use for the real embeddings. sentence_transformers is only needed if this is used """
+        from sentence_transformers import SentenceTransformer
+
+        self.name = f"sbert-{model_name}"
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts: list) -> np.ndarray:
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+
+
+class HashEncoder():
+    def __init__(self, dim: int = 384) -> None:
+        """
+        A deterministic stand in for a real encoder, e.g. for testing without a model or a gpu. Every word is hashed
+        to a fixed random unit vector and a text is the normalized sum of its words, so similar texts are still close
+        """
+        self.name = f"hash-{dim}"
+        self.dim = dim
+        self._word_vectors = {}
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            vector = self._word_vectors[word] = np.random.default_rng(zlib.crc32(word.encode("utf-8"))).standard_normal(self.dim)
+        return vector
+
+    def encode(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.split():
+                vectors[i] += self._word_vector(word)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+
+class EmbeddingCache():
+    def __init__(self, directory: str, encoder) -> None:
+        """
+        A cache of text hash -> vector on disk, one per encoder (different models give different vectors). Stored as
+        two append only files, the hashes and the float32 vectors in the same order
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.dim = encoder.dim
+        self.keys_path = os.path.join(directory, f"{encoder.name}.keys")
+        self.vectors_path = os.path.join(directory, f"{encoder.name}.vectors")
+
+        keys = open(self.keys_path, 'rb').read() if os.path.exists(self.keys_path) else b""
+        n_rows = min(len(keys) // DIGEST_SIZE, os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0)
+        self.rows = {keys[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]: i for i in range(n_rows)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return f"EmbeddingCache(keys_path={self.keys_path}, n_vectors={len(self)})"
+
+    def vectors(self) -> np.ndarray:
+        """ Memory map the cached vectors, row i is the vector of the key with row i """
+        if not self.rows:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self.rows), self.dim))
+
+    def add(self, keys: list, vectors: np.ndarray) -> None:
+        """ Append new vectors to the cache """
+        # Cut anything a killed job wrote after the last complete row, so the two files stay aligned
+        for path, row_size in [(self.keys_path, DIGEST_SIZE), (self.vectors_path, 4 * self.dim)]:
+            with open(path, 'ab') as file:
+                file.truncate(len(self.rows) * row_size)
+
+        with open(self.keys_path, 'ab') as keys_file, open(self.vectors_path, 'ab') as vectors_file:
+            vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            keys_file.write(b"".join(keys))
+        for key in keys:
+            self.rows[key] = len(self.rows)
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=DIGEST_SIZE).digest()
+
+
+def embed(corpus: list, encoder, cache_dir: str = None, batch_size: int = BATCH_SIZE) -> np.ndarray:
+    """
+    Embed every text of the corpus with the encoder, returns a float32 array with a row per text in the same order.
+
+    Only texts that arent in the cache yet are encoded, so rerunning on a (slightly) changed corpus only encodes the
+    texts that changed. The texts to encode are sorted by length before they are batched, so a batch holds texts of
+    about the same length and little time is spent on padding.
+
+    Parameters
+    ----------
+    corpus : list[str]
+        The (cleaned) texts
+    encoder : SBERTEncoder, HashEncoder or anything with a name, dim and encode(texts) -> np.ndarray
+        The model to embed with
+    cache_dir : str, optional
+        Directory of the cache of text hash -> vector, no caching if not given
+    batch_size : int, optional
+        Number of texts encoded at a time
+
+    Examples
+    --------
+    >>> embeddings = embed(corpus, SBERTEncoder('all-MiniLM-L6-v2'), cache_dir='/work3/s204163/wiki/embedding-cache')
+    """
+    keys = [text_hash(text) for text in corpus]
+    cache = EmbeddingCache(cache_dir, encoder) if cache_dir else None
+    known = set(cache.rows) if cache is not None else set()
+
+    # The texts that have to be encoded, every distinct text only once, sorted by length
+    missing = {}
+    for key, text in zip(keys, corpus):
+        if key not in known and key not in missing:
+            missing[key] = text
+    missing = sorted(missing.items(), key=lambda item: len(item[1]))
+    print(f"Encoding {len(missing)} of {len(corpus)} texts, the rest are cached or duplicates")
+
+    new_vectors = {}
+    pending_keys, pending_vectors = [], []
+    for i, start in enumerate(range(0, len(missing), batch_size)):
+        batch = missing[start:start + batch_size]
+        vectors = np.asarray(encoder.encode([text for _, text in batch]), dtype=np.float32)
+        for (key, _), vector in zip(batch, vectors):
+            new_vectors[key] = vector
+
+        if cache is not None:
+            pending_keys.extend(key for key, _ in batch)
+            pending_vectors.append(vectors)
+            if (i + 1) % BATCHES_PER_SAVE == 0:
+                cache.add(pending_keys, np.concatenate(pending_vectors))
+                pending_keys, pending_vectors = [], []
+                print(f"Encoded {start + len(batch)}/{len(missing)} texts")
+
+    if cache is not None and pending_keys:
+        cache.add(pending_keys, np.concatenate(pending_vectors))
+
+    # Put the vectors together in the order of the corpus, with a cache all of them are in it by now
+    if cache is not None:
+        return np.array(cache.vectors()[[cache.rows[key] for key in keys]])
+    return np.array([new_vectors[key] for key in keys], dtype=np.float32).reshape(len(keys), encoder.dim)
@@ -1,5 +1,9 @@
 import numpy as np
 
+from scipy.sparse import csr_matrix, issparse
+
+ROWS_PER_BLOCK = 10_000     # Number of points the distances to the centroids are computed for at a time
+
 class KMeans:
     def __init__(self, n_clusters:int = 3, n_iterations:int = 10, init_method: str = 'forgy'):
         """
@@ -40,7 +44,10 @@ class KMeans:
 
 
     def cluster(self, points, max_attempts: int = 100):
-        """ Apply the KMeans clustering algorithm """
+        """
+        Apply the KMeans clustering algorithm. The points can be a numpy array (also memory mapped, e.g. from
+        `load_features`) or a sparse CSR matrix like the TF-IDF features, which is never made dense
+        """
         best_labels = None
         best_centroids = None
         best_inertia = np.inf
@@ -72,10 +79,11 @@ class KMeans:
         return best_labels, best_centroids
 
     def calculate_inertia(self, data, centroids, labels):
+        """ The sum of squared distances of the points to the centroid of their cluster """
         inertia = 0
-        for k in range(self.n_clusters):
-            cluster_data = data[labels == k]
-            inertia += ((cluster_data - centroids[k]) ** 2).sum()
+        for start, distances in self._block_distances(data, centroids, squared_norms = True):
+            block_labels = labels[start:start + len(distances)]
+            inertia += np.maximum(distances[np.arange(len(distances)), block_labels], 0).sum(dtype=np.float64)
         return inertia
     
     def _ensamble_vote(self, labels_all_runs):
@@ -96,20 +104,57 @@ class KMeans:
         if self.init_method == 'forgy':
             # Pick K random points as the initial cluster centres
             indices = np.random.choice(points.shape[0], self.n_clusters, replace = False)
-            return points[indices]
+            centroids = points[indices]
+            return np.asarray(centroids.toarray() if issparse(centroids) else centroids, dtype=np.float32)
         else: 
             raise NotImplementedError("The given initialization method isnt implemented")
 
 
+    def _blocks(self, points):
+        """ Generator of (start row, block of at most ROWS_PER_BLOCK points as float32), dense or CSR like the points """
+        for start in range(0, points.shape[0], ROWS_PER_BLOCK):
+            block = points[start:start + ROWS_PER_BLOCK]
+            yield start, block.astype(np.float32) if issparse(block) else np.asarray(block, dtype=np.float32)
+
+
+    def _block_distances(self, points, centroids, squared_norms: bool = False):
+        """
+        Generator of (start row, squared distances of a block of points to every centroid), computed as
+        |x|^2 - 2 x.c + |c|^2 in float32 so the x.c part is one matrix product. A block is at most ROWS_PER_BLOCK
+        points, so only a ROWS_PER_BLOCK x k array is made instead of all points x k x dimensions. |x|^2 is the same
+        for every centroid, so it is only added if squared_norms (i.e. the distances are needed, not just the argmin)
+        """
+        centroids = np.asarray(centroids, dtype=np.float32)
+        centroid_norms = (centroids ** 2).sum(axis=1)
+
+        for start, block in self._blocks(points):
+            distances = np.asarray(block @ centroids.T) * -2 + centroid_norms
+            if squared_norms:
+                point_norms = block.multiply(block).sum(axis=1) if issparse(block) else (block ** 2).sum(axis=1)
+                distances += np.asarray(point_norms).reshape(-1, 1)
+            yield start, distances
+
+
     def _assign_clusters(self, points, centroids):
         """ Assign points to their closest clusters"""
-        distances = np.sqrt(((points - centroids[:, np.newaxis])**2).sum(axis=2))
-        return np.argmin(distances, axis=0)
+        labels = np.empty(points.shape[0], dtype=np.int64)
+        for start, distances in self._block_distances(points, centroids):
+            labels[start:start + len(distances)] = np.argmin(distances, axis=1)
+        return labels
 
 
     def _update_centroids(self, points, labels):
         """ Update the positions of the centroids to be the mean of the points assigned to that closter """
-        return np.array([points[labels == k].mean(axis=0) for k in range(self.n_clusters)])
+        # Sum the points of every cluster with a sparse k x block indicator matrix, works for both dense and CSR points
+        sums = np.zeros((self.n_clusters, points.shape[1]), dtype=np.float64)
+        for start, block in self._blocks(points):
+            block_labels = labels[start:start + block.shape[0]]
+            indicator = csr_matrix((np.ones(len(block_labels), dtype=np.float32), (block_labels, np.arange(len(block_labels)))), shape=(self.n_clusters, len(block_labels)))
+            block_sums = indicator @ block
+            sums += block_sums.toarray() if issparse(block_sums) else block_sums
+
+        counts = np.bincount(labels, minlength=self.n_clusters)
+        return (sums / counts[:, np.newaxis]).astype(np.float32)
 
 
 # Example usage
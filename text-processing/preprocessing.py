@@ -1,69 +1,153 @@
-import re
+import os
 import random
 import string
 import csv
+from functools import partial
+from multiprocessing import Pool
 
 import numpy as np
 
 from nltk.corpus import stopwords as sw
 from nltk.stem import PorterStemmer
-from sentence_transformers import SentenceTransformer
 
-from TFIDF import TFIDF
-from utils.read_data import read_articles_file, read_article_ids_file
+from TFIDF import TFIDF, read_text_chunks
+from embeddings import embed, SBERTEncoder
+from utils.read_data import read_articles_file
+from utils.id_table import save_id_table, IdTable
+from utils.feature_store import save_features
+from utils.parallel_scan import n_available_cores
 
 # TF-IDF parameters
 N_TFIDF_FEATURES = 200
 N_GRAM_ANALYZER = 'word' # ‘word’, ‘char’, ‘char_wb’
 N_MAX_CHARS = 1500
 
+# Preprocessing parameters
+TEXTS_PER_TASK = 500    # Number of texts a worker preprocesses at a time
+WINDOW_CHARS = 10_000   # Texts are normalized this many characters at a time, so we can stop early when truncating
+
 # Translator for removing punctuation, including non unicode U+2013 character "–", very common
 punctuation_translator = str.maketrans(string.punctuation + '\u2013', " " * (len(string.punctuation) + 1))
 
+# Translator for removing numbers and punctuation in the same pass. It works on utf-8 bytes since str.translate is
+# 10x slower as soon as a text has a single non ascii character. Digits and punctuation are single bytes in utf-8
+clean_translator = bytes.maketrans((string.digits + string.punctuation).encode(), b" " * (len(string.digits) + len(string.punctuation)))
+
 # List of stopwords and a stemmer from nltk that does simple stemming
 stemmer = PorterStemmer()
 stopwords = set(sw.words("english"))
 
+# The same few thousand words make up most of the text, so every word is only stemmed once. New stems are also
+# kept in new_stems so the workers can send them back and the cache can be saved for the next run
+stem_cache = {}
+new_stems = {}
 
-def remove_numbers(text:str) -> str:
-    """ Match all digits in the string and replace them with an empty string """
-    new_text = re.sub(r'[0-9]', ' ', text)
-    return new_text
 
+def clean(text: str) -> str:
+    """ Strip the text of punctutaion, numbers, excessive spaces, etc. """
+    # Split also removes double+ spacing and newlines
+    return " ".join(remove_numbers_and_punctuation(text).lower().split())
 
-def remove_blank_space(text: str) -> str:
-    """ Stolen from: https://stackoverflow.com/a/1546244"""
-    # return re.sub(' +', ' ', text)        # Doesnt really work
-    # return re.sub(' {2,}', ' ', text)     # Doesnt really work
-    return " ".join(text.split()) # TODO: Slooowwwwww
 
+def remove_numbers_and_punctuation(text: str) -> str:
+    """ Replace all digits and punctuation (including "–") with spaces in one pass """
+    text = text.encode("utf-8", "surrogatepass").translate(clean_translator).replace("\u2013".encode(), b" ")
+    return text.decode("utf-8", "surrogatepass")
 
-def clean(text: str) -> str:
-    """ Strip the text of punctutaion, numbers, excessive spaces, etc. """
-    text = remove_numbers(text)                                         # remove numbers
-    text = text.translate(punctuation_translator)                       # remove punctuation: !"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~
-    text = text.lower()                                                 # convert to lower case
-    text = remove_blank_space(text)                                     # remove double+ spacing
-    text = text.strip()                                                 # remove newline characters and spaces
-    return text
 
+def tokens(text: str, max_chars: int = None):
+    """
+    Generator of the preprocessed words of a text, i.e. cleaned, without stop words and stemmed. Does the same as
+    `preprocess` in one pass over the text, and if `max_chars` is given it stops once the words would fill
+    `max_chars` characters - so only the start of long texts is ever read
+    """
+    n_chars = 0
+    window = max(len(text), 1) if max_chars is None else WINDOW_CHARS
+    rest = ""
+    for start in range(0, len(text), window):
+        piece = rest + remove_numbers_and_punctuation(text[start:start + window])
 
-def preprocess(text: str) -> str:
+        # A word may continue in the next window, keep everything after the last space for then
+        end = len(piece) if len(text) <= start + window else piece.rfind(" ") + 1
+        piece, rest = piece[:end], piece[end:]
+
+        for word in piece.lower().split():
+            if word in stopwords:
+                continue
+            word = stem(word)
+            yield word
+
+            n_chars += len(word) + 1
+            if max_chars is not None and max_chars < n_chars:
+                return
+
+
+def preprocess(text: str, max_chars: int = None) -> str:
     """
     Do preprocessing which includes:
         - cleaning text
         - removing stop words
         - stemming words
+        - shortening the text to max_chars, if given
     """
-    text = clean(text)
-    
     # Do stop word removal and stemming in one pass, looks messy saves some time
-    words = text.split()
-    return " ".join([stemmer.stem(word) for word in words if not word in stopwords])
+    return " ".join(tokens(text, max_chars))[:max_chars]
+
+
+def stem(word: str) -> str:
+    """ Stem a word with the porter stemmer, looking it up in the cache first """
+    stemmed = stem_cache.get(word)
+    if stemmed is None:
+        stemmed = stem_cache[word] = new_stems[word] = stemmer.stem(word)
+    return stemmed
 
 
-def shorten_texts(corpus: list, max_chars: int = 10_000):
-    return [text[:max_chars] for text in corpus]
+def load_stem_cache(file_path: str) -> dict:
+    """ Load a stem cache saved with `save_stem_cache`, an empty cache if it doesnt exist yet """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, 'r', encoding="utf-8") as file:
+        return dict(line.split(" ") for line in file.read().splitlines())
+
+
+def save_stem_cache(file_path: str, cache: dict) -> None:
+    """ Save the stem cache as lines of "word stem", the words never contain spaces after cleaning """
+    with open(file_path, 'w', encoding="utf-8") as file:
+        file.writelines(f"{word} {stemmed}\n" for word, stemmed in cache.items())
+
+
+def _init_worker(cache: dict) -> None:
+    stem_cache.update(cache)
+
+
+def _preprocess_texts(max_chars: int, texts: list) -> tuple:
+    """ Preprocess a chunk of texts in a worker, returns the texts and the stems the worker learned since the last chunk """
+    corpus = [preprocess(text, max_chars) for text in texts]
+    stems = dict(new_stems)
+    new_stems.clear()
+    return corpus, stems
+
+
+def preprocess_corpus(raw_corpus: list, n_workers: int = None, stem_cache_path: str = None, max_chars: int = None) -> list:
+    """
+    Preprocess every text of the corpus on `n_workers` processes (all cores by default). The corpus is split in chunks
+    and the preprocessed texts are returned in the same order, i.e. still aligned with the article ids. If a path is
+    given the stem cache is loaded from it first and saved to it with the stems of this corpus added afterwards.
+    The texts are shortened to `max_chars` while preprocessing them, if given
+    """
+    cache = load_stem_cache(stem_cache_path) if stem_cache_path else {}
+    chunks = [raw_corpus[i:i + TEXTS_PER_TASK] for i in range(0, len(raw_corpus), TEXTS_PER_TASK)]
+
+    corpus = []
+    with Pool(n_workers or n_available_cores(), initializer=_init_worker, initargs=(cache,)) as pool:
+        # imap keeps the order of the chunks
+        for texts, stems in pool.imap(partial(_preprocess_texts, max_chars), chunks):
+            corpus.extend(texts)
+            cache.update(stems)
+
+    if stem_cache_path:
+        save_stem_cache(stem_cache_path, cache)
+    return corpus
 
 
 def random_articles(articles: set, N : int, seed: int = 0) -> set:
@@ -81,39 +165,45 @@ if __name__ == "__main__":
     N = None # Read all the data
 
     article_texts_path = "/work3/s204163/wiki/article_texts"
-    article_ids_path = "/work3/s204163/wiki/article_ids"
+    id_table_path = "/work3/s204163/wiki/article_ids.table"
     clean_texts_path = "/work3/s204163/wiki/cleaned_texts"
-    tfidf_features_path = "/work3/s204163/wiki/tfidffeatures.csv"
-    sbert_features_path = "/work3/s204163/wiki/sbertfeatures.csv"
+    tfidf_features_path = "/work3/s204163/wiki/tfidf.features"
+    tfidf_model_path = "/work3/s204163/wiki/tfidf.model"
+    sbert_features_path = "/work3/s204163/wiki/sbert.features"
+    stem_cache_path = "/work3/s204163/wiki/stems"
+    embedding_cache_path = "/work3/s204163/wiki/embedding-cache"
 
     all_articles = read_articles_file(article_texts_path, N = N, read_titles = True)
-    article_ids = read_article_ids_file(article_ids_path, N = N)
+
+    # The row order of every artifact we write is the order of the articles, save it once for all consumers
+    article_ids = list(all_articles.keys())
+    save_id_table(id_table_path, article_ids)
+    id_table_checksum = IdTable(id_table_path).checksum()
 
     print(f"Read {len(all_articles)} articles")
     print("Preprocessing...")
     
-    # Preprocess the texts: clean, remove stopwords, stem, etc.
+    # Preprocess the texts: clean, remove stopwords, stem, shorten etc. on all cores
     raw_corpus = list(all_articles.values())
-    corpus = [preprocess(text) for text in raw_corpus]
-
-    # Shorten the texts to 
-    corpus = shorten_texts(corpus, max_chars = N_MAX_CHARS)
+    corpus = preprocess_corpus(raw_corpus, stem_cache_path = stem_cache_path, max_chars = N_MAX_CHARS)
 
     # Save the cleaned texts
-    with open(clean_texts_path, 'w') as result_file:
+    with open(clean_texts_path, 'w', newline = '', encoding = "utf-8") as result_file:
         wr = csv.writer(result_file)
         wr.writerows(zip(article_ids, corpus))
 
     # Do tfidf
     print("tf-idf...")
-    tfidf = TFIDF(N_TFIDF_FEATURES)
-    X = tfidf.vectorize(corpus)
-    np.savetxt(tfidf_features_path, X, delimiter=",")
-
-    # Do SBERT
+    # Out of core, straight from the cleaned texts: the documents are counted a chunk at a time on all cores and
+    # the rows are written to the memory mapped feature file in a second pass
+    tfidf = TFIDF(N_TFIDF_FEATURES).fit_chunks(read_text_chunks(clean_texts_path))
+    tfidf.transform_to_file(read_text_chunks(clean_texts_path), tfidf_features_path, len(article_ids), "tfidf", id_table_checksum)
+    # The vocabulary and idf, so new articles can be vectorized without refitting (TFIDF().load(path).transform(texts))
+    tfidf.save(tfidf_model_path)
+
+    # Do SBERT, only the texts that changed since the last run are encoded
     print("s-bert ...")
-    sbert = SentenceTransformer('all-MiniLM-L6-v2')
-    embeddings = sbert.encode(corpus)
-    np.savetxt(sbert_features_path, embeddings, delimiter=",")
+    embeddings = embed(corpus, SBERTEncoder('all-MiniLM-L6-v2'), cache_dir = embedding_cache_path)
+    save_features(sbert_features_path, embeddings, "sbert", id_table_checksum, dtype = np.float16)
 
     print("Done!")
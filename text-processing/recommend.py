@@ -1,6 +1,8 @@
 import numpy as np
 
-from utils.read_data import read_article_ids_file, read_articles_file
+from utils.article_store import ArticleStore
+from utils.id_table import IdTable
+from utils.feature_store import load_features, load_labels, FEATURES_SUFFIX, LABELS_SUFFIX
 
 def _find_closest_articles(idx: int, n: int, X: np.ndarray, labels: np.ndarray) -> list[int]:
     """
@@ -26,13 +28,13 @@ def _find_closest_articles(idx: int, n: int, X: np.ndarray, labels: np.ndarray)
     """
 
 
-    # Get the vector and the label we are looking for
-    vec = X[idx]
+    # Get the vector and the label we are looking for, features may be stored as float16 so compute in float32
+    vec = np.asarray(X[idx], dtype=np.float32)
     label = labels[idx]
 
     # Find indices of vectors in the same class in the original dataset
     same_class_indices = np.where(labels == label)[0]
-    same_class = X[same_class_indices]
+    same_class = np.asarray(X[same_class_indices], dtype=np.float32)
 
     # calculate and sort by distance
     dists = np.linalg.norm(same_class - vec, axis=1)
@@ -41,7 +43,7 @@ def _find_closest_articles(idx: int, n: int, X: np.ndarray, labels: np.ndarray)
     return original_indices[:n]
 
 
-def recommend(ids: list[int], n: int = 10, embedding_method: str = 'tfidf', cluster_method: str = 'kmeans', article_ids_path: str = "/work3/s204163/wiki/article_ids") -> list[int]:
+def recommend(ids: list[int], n: int = 10, embedding_method: str = 'tfidf', cluster_method: str = 'kmeans', id_table_path: str = "/work3/s204163/wiki/article_ids.table") -> list[int]:
     """
     Provides recommendations for a user who has edited a list of articles. 
     Finds similar article based on precomputed feature-vectors and class labels from clustering.
@@ -56,8 +58,8 @@ def recommend(ids: list[int], n: int = 10, embedding_method: str = 'tfidf', clus
         The embedding to use when recommending, choices are: 'tfidf', 'sbert'
     cluster_method : str, default = 'k-means'
         The clustering method to use, choices are: 'kmeans', 'dbscan'
-    article_ids_path : str, optional
-        Path to the article IDs, default is '/work3/s204163/wiki/article_ids'.
+    id_table_path : str, optional
+        Path to the article id <-> row table written by preprocessing, default is '/work3/s204163/wiki/article_ids.table'.
 
     Returns
     -------
@@ -70,28 +72,24 @@ def recommend(ids: list[int], n: int = 10, embedding_method: str = 'tfidf', clus
     # Returns a list of IDs for 5 articles recommended based on the article with ID 12345.
     """
     
-    # Read the article_ids from the dataset
-    article_ids = read_article_ids_file(article_ids_path)
+    # The mapping between the ids of the articles and their position in the arrays
+    id_table = IdTable(id_table_path)
     
     # Get the paths of features and labels based on function input
     base_path = "/work3/s204163/wiki/"
-    features_path = f"{base_path}{embedding_method}features.csv"
-    text_labels_path = f"{base_path}text_labels_{embedding_method}_{cluster_method}.csv"
-    
-    # Read the labels from clustering (so we dont have to compute them for every recommendation), 
-    # Also read the features vectors we dont have to compute them every time
-    labels = np.genfromtxt(text_labels_path, dtype=np.int32, delimiter=",")
-    features = np.loadtxt(features_path, delimiter= ",")
-
-    # Create a maping from position in array to id of article and vice versa
-    id2index = {id : i for (i, id) in enumerate(article_ids)}
-    index2id  = {i : id for (i, id) in enumerate(article_ids)}
+    features_path = f"{base_path}{embedding_method}{FEATURES_SUFFIX}"
+    text_labels_path = f"{base_path}text_labels_{embedding_method}_{cluster_method}{LABELS_SUFFIX}"
     
+    # Memory map the labels from clustering (so we dont have to compute them for every recommendation),
+    # and the features vectors so we dont have to compute them every time. Both have to match the id table
+    checksum = id_table.checksum()
+    labels = load_labels(text_labels_path, checksum)
+    features = load_features(features_path, checksum)
+
     # Do recommendations
     recommendations = set()
-    for id in ids:
-        idx = id2index[id]                                                          # get the index of the id
-        r = [index2id[i] for i in _find_closest_articles(idx, n, features, labels)] # add recommendations for this id
+    for idx in id_table.ids_to_rows(ids):                                                   # get the indices of the ids
+        r = id_table.rows_to_ids(_find_closest_articles(idx, n, features, labels)).tolist() # add recommendations for this id
         recommendations.update(r)
     
     # Return the ids of the closest articles
@@ -100,13 +98,11 @@ def recommend(ids: list[int], n: int = 10, embedding_method: str = 'tfidf', clus
 
 if __name__ == "__main__":
 
-    # Read the data 
+    # Open the articles, only the ones we print are read from disk
     article_texts_path = "/work3/s204163/wiki/article_texts"
-    article_ids_path = "/work3/s204163/wiki/article_ids"
-    all_articles = read_articles_file(article_texts_path, read_titles = True, return_titles = False)
-    article_ids = read_article_ids_file(article_ids_path)
+    all_articles = ArticleStore(article_texts_path)
 
     # Test it works, get the 20 closest articles to some random articles
     neighbours_idx = recommend([11920088], n = 20, embedding_method='sbert', cluster_method='kmeans')
     for id in neighbours_idx:
-        print(f"{id} : {all_articles[id][:100]}")
\ No newline at end of file
+        print(f"{id} : {all_articles.get_text(id)[:100]}")
\ No newline at end of file
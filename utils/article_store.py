@@ -0,0 +1,132 @@
+import os
+import mmap
+
+import numpy as np
+
+from utils.read_data import DELIMITER
+from utils.index_file import save_index_file, load_index_file, index_file_metadata
+
+ARTICLE_INDEX_SUFFIX = ".index"     # The index of an article file is saved next to it, e.g. article_texts.index
+
+
+def create_article_index_file(file_path: str, delimiter: str = DELIMITER) -> None:
+    """
+    Index an article file (lines of id|å|ø|å|title|å|ø|å|text, see `utils/create_text_dataset.py`) by the byte
+    offset and length of the line of every article id. The ids are sorted so they can be looked up with searchsorted.
+    The size and modification time of the article file are saved with the index, see `article_index_is_current`
+    """
+    delimiter = delimiter.encode("utf-8")
+    article_ids, offsets, lengths = [], [], []
+    stat = os.stat(file_path)
+
+    with open(file_path, 'rb') as file:
+        offset = 0
+        for line in file:
+            article_ids.append(int(line[:line.index(delimiter)]))
+            offsets.append(offset)
+            lengths.append(len(line))
+            offset += len(line)
+
+    order = np.argsort(article_ids, kind='stable')
+    save_index_file(f"{file_path}{ARTICLE_INDEX_SUFFIX}", {
+        "article_id": np.asarray(article_ids, dtype=np.int64)[order],
+        "offset"    : np.asarray(offsets, dtype=np.int64)[order],
+        "length"    : np.asarray(lengths, dtype=np.int64)[order],
+    }, metadata = {"file_size": stat.st_size, "file_mtime_ns": stat.st_mtime_ns})
+
+
+def article_index_is_current(file_path: str) -> bool:
+    """ Whether the index of an article file exists and was made from the file as it is now, i.e. it wasnt rewritten since """
+    index_path = f"{file_path}{ARTICLE_INDEX_SUFFIX}"
+    if not os.path.exists(index_path):
+        return False
+    stat = os.stat(file_path)
+    return index_file_metadata(index_path) == {"file_size": stat.st_size, "file_mtime_ns": stat.st_mtime_ns}
+
+
+class ArticleStore:
+    def __init__(self, file_path: str, delimiter: str = DELIMITER):
+        """
+        Random access to the articles in an article file without reading it into memory. The file is memory
+        mapped and a sidecar index of id -> (offset, length) finds the line of an article, so looking up an
+        article only reads that article. The index is made the first time a file is opened, and made again if
+        the file changed since (e.g. after refreshing article_texts).
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the article file, e.g. /work3/s204163/wiki/article_texts
+        delimiter : str, optional
+            The delimiter between the id, title and text
+
+        Examples
+        --------
+        >>> articles = ArticleStore('/work3/s204163/wiki/article_texts')
+        >>> articles.get_title(11920088), articles.get_text(11920088)[:100]
+        >>> for article_id, title, text in articles:
+        ...     print(article_id, title)
+        """
+        self.file_path = file_path
+        self.delimiter = delimiter
+
+        if not article_index_is_current(file_path):
+            create_article_index_file(file_path, delimiter)
+        index = load_index_file(f"{file_path}{ARTICLE_INDEX_SUFFIX}")
+        self.article_ids, self.offsets, self.lengths = index[:, 0], index[:, 1], index[:, 2]
+
+        with open(file_path, 'rb') as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file_path) else b""
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def __repr__(self):
+        return f"ArticleStore(file_path={self.file_path}, n_articles={len(self)})"
+
+    def __contains__(self, article_id: int):
+        i = np.searchsorted(self.article_ids, article_id)
+        return i < len(self.article_ids) and self.article_ids[i] == article_id
+
+    def __iter__(self):
+        """ Stream (article_id, title, text) of all the articles in the order of the file """
+        for batch in self.batches():
+            yield from batch
+
+    def _position(self, article_id: int) -> int:
+        i = np.searchsorted(self.article_ids, article_id)
+        if len(self.article_ids) <= i or self.article_ids[i] != article_id:
+            raise KeyError(f"Article {article_id} is not in {self.file_path}")
+        return i
+
+    def _parse(self, offset: int, length: int) -> tuple:
+        """ Parse the line at the offset into (article_id, title, text), title is None for files without titles """
+        fields = self._data[offset:offset + length].decode("utf-8").removesuffix("\n").split(self.delimiter)
+        if len(fields) == 3:
+            return (int(fields[0]), fields[1], fields[2])
+        return (int(fields[0]), None, fields[1])
+
+    def get(self, article_id: int) -> tuple:
+        """ Get the (title, text) of an article """
+        i = self._position(article_id)
+        _, title, text = self._parse(int(self.offsets[i]), int(self.lengths[i]))
+        return (title, text)
+
+    def get_title(self, article_id: int) -> str:
+        """ Get the title of an article """
+        return self.get(article_id)[0]
+
+    def get_text(self, article_id: int) -> str:
+        """ Get the text of an article """
+        return self.get(article_id)[1]
+
+    def get_many(self, article_ids: list) -> list:
+        """ Get the (title, text) of many articles, reading them in the order they are in the file """
+        positions = [self._position(article_id) for article_id in article_ids]
+        articles = {i: self._parse(int(self.offsets[i]), int(self.lengths[i]))[1:] for i in sorted(positions, key=lambda i: self.offsets[i])}
+        return [articles[i] for i in positions]
+
+    def batches(self, batch_size: int = 1000):
+        """ Stream lists of up to `batch_size` (article_id, title, text) in the order of the file, e.g. for preprocessing """
+        file_order = np.argsort(self.offsets, kind='stable')
+        for start in range(0, len(file_order), batch_size):
+            yield [self._parse(int(self.offsets[i]), int(self.lengths[i])) for i in file_order[start:start + batch_size]]
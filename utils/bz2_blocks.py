@@ -0,0 +1,171 @@
+import io
+import bz2
+from itertools import chain
+
+# A bzip2 file is a sequence of streams, each stream is a sequence of compressed blocks. Blocks are NOT
+# aligned to bytes, but every block starts with a 48 bit magic number and every stream ends with another
+# 48 bit magic number. See: https://en.wikipedia.org/wiki/Bzip2#File_format
+BLOCK_MAGIC = 0x314159265359            # BCD of pi
+END_OF_STREAM_MAGIC = 0x177245385090    # BCD of sqrt(pi)
+MAGIC_BITS = 48
+STREAM_HEADER = b"BZh9"                 # Blocks are at most 900k, so a level 9 header can decompress any block
+
+MAX_BLOCK_INPUT = 700_000              # Data of at most this size always compresses to a single block (blocks hold 900k after a run length encoding that expands by at most 1.25)
+
+CHUNK_SIZE = 1 << 22                    # Read the compressed file 4MB at a time when searching it
+DECOMPRESS_CHUNK_SIZE = 1 << 16         # Feed the decompressor 64KB at a time, so readers that stop early dont decompress much more than they need
+
+
+def _magic_patterns(magic: int) -> list:
+    """
+    A 48 bit magic number starting at bit `shift` of a byte spans 7 bytes, of which the middle 5 are
+    completely determined by the magic. Returns a list of (shift, pattern) that can be found with bytes.find
+    """
+    return [(shift, (magic << (8 - shift)).to_bytes(7, 'big')[1:6]) for shift in range(8)]
+
+
+def _is_magic(window: bytes, shift: int, magic: int) -> bool:
+    """ Check if the 7 byte window contains the full magic number at the given bit shift """
+    return len(window) == 7 and (int.from_bytes(window, 'big') >> (8 - shift)) & ((1 << MAGIC_BITS) - 1) == magic
+
+
+def find_magic_offsets(file_path: str, magic: int, chunk_size: int = CHUNK_SIZE) -> list:
+    """
+    Find the bit offset of every occurrence of a 48 bit magic number in a (bzip2) file. Uses bytes.find for
+    all 8 bit alignments, so it runs at close to disk speed instead of decompression speed.
+    """
+    patterns = _magic_patterns(magic)
+    offsets = set()
+
+    with open(file_path, 'rb') as file:
+        chunk_start = 0
+        overlap = b""
+        while chunk := file.read(chunk_size):
+            # Keep the last bytes of the previous chunk around so we dont miss magics spanning two chunks
+            data = overlap + chunk
+            data_start = chunk_start - len(overlap)
+
+            for shift, pattern in patterns:
+                position = data.find(pattern)
+                while position != -1:
+                    window_start = position - 1
+                    window = data[window_start:window_start + 7] if 0 <= window_start else b""
+                    if _is_magic(window, shift, magic):
+                        offsets.add((data_start + window_start) * 8 + shift)
+                    position = data.find(pattern, position + 1)
+
+            chunk_start += len(chunk)
+            overlap = data[-7:]
+
+    return sorted(offsets)
+
+
+def find_blocks(file_path: str, chunk_size: int = CHUNK_SIZE) -> list:
+    """
+    Find the (start_bit, end_bit) of every compressed block in a bzip2 file. A block ends where the next block
+    starts, or at the end-of-stream marker of its stream (files made by e.g. pbzip2 have many streams).
+
+    Notes
+    -----
+    The magic can in theory show up by chance inside compressed data (p = 2^-48 per bit), this is
+    astronomically unlikely for our data and is not handled.
+    """
+    block_starts = find_magic_offsets(file_path, BLOCK_MAGIC, chunk_size)
+    stream_ends = find_magic_offsets(file_path, END_OF_STREAM_MAGIC, chunk_size)
+
+    boundaries = sorted(block_starts + stream_ends)
+    ends = {start: end for start, end in zip(boundaries, boundaries[1:])}
+
+    return [(start, ends[start]) for start in block_starts]
+
+
+def read_bits(file, start_bit: int, end_bit: int, chunk_size: int = CHUNK_SIZE):
+    """
+    Generator of the bits [start_bit, end_bit) of an open binary file, shifted so they start on a byte
+    boundary. The last byte is padded with zero bits.
+    """
+    shift = start_bit % 8
+    position = start_bit // 8
+    end_byte = (end_bit + 7) // 8
+    bits_left = end_bit - start_bit
+
+    file.seek(position)
+    data = file.read(min(chunk_size, end_byte - position))
+    while 0 < bits_left and data:
+        position += len(data)
+        next_data = file.read(min(chunk_size, end_byte - position)) if position < end_byte else b""
+
+        # Byte k of the output is the low bits of byte k and the high bits of byte k + 1 of the input
+        window = int.from_bytes(data + (next_data[:1] or b"\x00"), 'big')
+        n_bytes = len(data)
+        aligned = (window >> (8 - shift)) & ((1 << (8 * n_bytes)) - 1)
+
+        # Cut away whatever is past the end bit
+        if bits_left < 8 * n_bytes:
+            n_bytes = (bits_left + 7) // 8
+            aligned >>= 8 * len(data) - 8 * n_bytes
+            aligned &= ~((1 << (8 * n_bytes - bits_left)) - 1)
+
+        yield aligned.to_bytes(n_bytes, 'big')
+        bits_left -= 8 * n_bytes
+        data = next_data
+
+
+def decompress_blocks(file_path: str, blocks: list, chunk_size: int = DECOMPRESS_CHUNK_SIZE):
+    """
+    Generator of the decompressed bytes of a list of (start_bit, end_bit) blocks, without decompressing
+    anything that comes before them. Consecutive blocks of the same stream share a decompressor, a new one is
+    started whenever there is a gap (e.g. a new stream).
+    """
+    with open(file_path, 'rb') as file:
+        run_start, run_end = None, None
+        for start, end in chain(blocks, [(None, None)]):
+            if run_end is not None and start == run_end:
+                run_end = int(end)
+                continue
+
+            # Decompress the previous run of consecutive blocks, by prefixing it with a fake stream header
+            if run_start is not None:
+                decompressor = bz2.BZ2Decompressor()
+                yield decompressor.decompress(STREAM_HEADER)
+                for data in read_bits(file, run_start, run_end, chunk_size):
+                    yield decompressor.decompress(data)
+
+                # The decompressor holds on to output once it runs out of input, and there is no end-of-stream to
+                # flush it, so keep asking until it is empty
+                while data := decompressor.decompress(b""):
+                    yield data
+
+            run_start, run_end = (None, None) if start is None else (int(start), int(end))
+
+
+def compress_block(data: bytes) -> tuple:
+    """
+    Compress data to a bzip2 stream of a single block. Returns the stream and the (start_bit, end_bit) of its
+    block within the stream, so streams can be concatenated into a file and indexed without searching it again
+    """
+    if not 0 < len(data) <= MAX_BLOCK_INPUT:
+        raise ValueError(f"Between 1 and {MAX_BLOCK_INPUT} bytes fit in a single block, got {len(data)}")
+    stream = bz2.compress(data, 9)
+
+    # The stream ends with the end-of-stream magic, a 32 bit crc and 0-7 bits of padding
+    tail = int.from_bytes(stream[-11:], 'big')
+    for padding in range(8):
+        if (tail >> (32 + padding)) & ((1 << MAGIC_BITS) - 1) == END_OF_STREAM_MAGIC:
+            return stream, len(STREAM_HEADER) * 8, len(stream) * 8 - MAGIC_BITS - 32 - padding
+    raise ValueError("Could not find the end of the stream")
+
+
+def iter_lines(chunks, encoding: str = "utf-8"):
+    """ Split a stream of byte chunks into decoded lines, keeping the newline like iterating a file does """
+    rest = b""
+    for chunk in chunks:
+        data = rest + chunk
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+
+        # Decode all the complete lines of the chunk at once, a StringIO splits them in C and only on "\n"
+        if end:
+            yield from io.StringIO(data[:end].decode(encoding), newline="\n")
+    if rest:
+        yield rest.decode(encoding)
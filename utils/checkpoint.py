@@ -0,0 +1,84 @@
+import os
+import json
+import time
+
+CHECKPOINT_SUFFIX = ".checkpoint"   # The checkpoint of a job is saved next to its output, e.g. wiki-revisions-filtered.bz2.checkpoint
+CHECKPOINT_INTERVAL = 10 * 60       # Seconds between checkpoints, a killed job loses at most this much work
+
+
+class Checkpoint:
+    def __init__(self, file_path: str, output_path: str = None, interval: float = CHECKPOINT_INTERVAL):
+        """
+        Periodic checkpoints of a long scan, so a job killed by the 24h walltime (or a node failure) can pick up where
+        it stopped. A checkpoint is a small json file of the state of the scan (revision number, block, etc.) and the
+        size of the output written so far. The output is append only, on resume it is truncated back to the size of
+        the last checkpoint, which throws away anything written after it.
+
+        Parameters
+        ----------
+        file_path : str
+            Path to the checkpoint file
+        output_path : str, optional
+            Path to the (partial) output of the scan, defaults to `file_path`.partial
+        interval : float, optional
+            Seconds between checkpoints, see `due`
+
+        Examples
+        --------
+        >>> checkpoint = Checkpoint('/work3/s204163/wiki/job.checkpoint')
+        >>> state = checkpoint.state or {"revision": 0}
+        >>> with checkpoint.open_output() as output:
+        ...     for revision, data in scan(start = state["revision"]):
+        ...         output.write(data)
+        ...         if checkpoint.due():
+        ...             checkpoint.save({"revision": revision}, output)
+        >>> checkpoint.remove()
+        """
+        self.file_path = file_path
+        self.output_path = output_path or f"{file_path}.partial"
+        self.interval = interval
+        self.state = None
+        self._last_save = time.monotonic()
+
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                self.state = json.load(file)
+            if not os.path.exists(self.output_path) or os.path.getsize(self.output_path) < self.state["output_size"]:
+                raise ValueError(f"The output {self.output_path} of the checkpoint {file_path} is missing or too short, delete the checkpoint to start over")
+
+    def __repr__(self):
+        return f"Checkpoint(file_path={self.file_path}, state={self.state})"
+
+    def open_output(self):
+        """ Open the output for appending in binary, truncated to the size it had at the last checkpoint """
+        output_size = self.state["output_size"] if self.state else 0
+        output = open(self.output_path, 'r+b' if output_size else 'wb')
+        output.truncate(output_size)
+        output.seek(output_size)
+        return output
+
+    def due(self) -> bool:
+        """ Check if it has been `interval` seconds since the last checkpoint """
+        return self.interval <= time.monotonic() - self._last_save
+
+    def save(self, state: dict, output) -> None:
+        """
+        Save the state of the scan, after everything up to it has been written to the output. The output is synced
+        to disk first and the checkpoint is replaced in one go, so a crash while saving leaves the previous checkpoint
+        """
+        output.flush()
+        os.fsync(output.fileno())
+
+        self.state = {**state, "output_size": output.tell()}
+        with open(f"{self.file_path}.tmp", 'w') as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{self.file_path}.tmp", self.file_path)
+        self._last_save = time.monotonic()
+
+    def remove(self, remove_output: bool = False) -> None:
+        """ Remove the checkpoint once the scan is done, and the partial output if it isnt the final output """
+        for path in [self.file_path] + ([self.output_path] if remove_output else []):
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,39 +1,82 @@
-import bz2
+import io
+from functools import partial
+from multiprocessing import Pool
 
+import numpy as np
 
-def create_index_file(file_path: str, index_row_spacing: int, rows_per_revision: int) -> dict:
+from utils.bz2_blocks import find_blocks, decompress_blocks
+from utils.index_file import save_index_file
+from utils.read_data import BLOCK_INDEX_SUFFIX
+from utils.parallel_scan import n_available_cores, BLOCKS_PER_CHUNK
+from utils.checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+
+
+def create_block_index_file(file_path: str, n_workers: int = None, checkpoint_path: str = None) -> list:
     """
-    Create an index file that allow for faster look up in the gzip2 file by logging the
-    byte location at every N rows.
-    An index file is just the byte location of every N row in the file
-    Is a one time operation that allows to faster look revisions and grab random ones, so it is worth the upfront cost
-    Takes around ~3 hours to run on a single cpu on hpc.
+    Create an index of the compressed bzip2 blocks of the file. For every block we log its (start_bit, end_bit)
+    in the compressed file and the number of rows that come before it, so we can jump straight to the block
+    holding a given row and decompress only from there - unlike byte positions in the uncompressed file, which
+    still require decompressing everything before them.
+    Every block is decompressed once to count its rows, the blocks are independent so this is done on all cores.
+    The blocks are counted a group at a time, if a checkpoint path is given the rows of every block so far are
+    checkpointed between groups and a restarted job continues from the last checkpoint.
     """
+    blocks = find_blocks(file_path)
+    n_workers = n_workers or n_available_cores()
+    group_size = BLOCKS_PER_CHUNK * n_workers
+
+    # The number of rows of every block is written to the partial output as int64s as the groups are counted
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+    start = checkpoint.state["block"] if checkpoint and checkpoint.state else 0
+    if start:
+        print(f"Resuming from block {start}/{len(blocks)}")
+    rows_per_block = checkpoint.open_output() if checkpoint else io.BytesIO()
 
-    index = {}
+    with Pool(n_workers) as pool:
+        for group_start in range(start, len(blocks), group_size):
+            group = blocks[group_start:group_start + group_size]
+            rows_per_block.write(np.array(pool.map(partial(count_rows_in_block, file_path), group, chunksize = 16), dtype=np.int64).tobytes())
 
-    # Crete the index
-    with bz2.open(file_path, 'rb') as file:
-        byte_position = file.tell()
-        for i, _ in enumerate(file):
-            if i % index_row_spacing == 0:        
-                # Add the true row number, revision number, and byte position to the index
-                index[i // ROWS_PER_REVISION] = byte_position
-                # print(f"Read {i}/1632271984 lines")
+            if checkpoint and checkpoint.due():
+                checkpoint.save({"block": group_start + len(group)}, rows_per_block)
+                print(f"Read {group_start + len(group)}/{len(blocks)} blocks")
 
-            byte_position = file.tell() # Get the position of the row in bytes PRIOR to reading it        
+    if checkpoint:
+        rows_per_block.close()
+        with open(checkpoint.output_path, 'rb') as file:
+            rows_per_block = np.frombuffer(file.read(), dtype=np.int64)
+        checkpoint.remove(remove_output=True)
+    else:
+        rows_per_block = np.frombuffer(rows_per_block.getvalue(), dtype=np.int64)
+
+    index = []
+    first_row = 0
+    for (start_bit, end_bit), n_rows in zip(blocks, rows_per_block.tolist()):
+        index.append((start_bit, end_bit, first_row))
+        first_row += n_rows
+
+    # A last entry with no bits marks the total number of rows in the file
+    end_bit = blocks[-1][1] if blocks else 0
+    index.append((end_bit, end_bit, first_row))
 
     return index
 
-if __name__ == "__main__":
-    ROWS_PER_REVISION = 14                                          # The number of rows in a single revision object, should never change
-    REVISIONS_PER_INDEX = 50                                        # How many revisions should there be between indexing
-    INDEX_ROWS_SPACING = ROWS_PER_REVISION * REVISIONS_PER_INDEX    # How many rows of the .bz2 file should pass between indexing
 
+def count_rows_in_block(file_path: str, block: tuple) -> int:
+    """ Decompress a single block and count the newlines in it """
+    return sum(chunk.count(b"\n") for chunk in decompress_blocks(file_path, [block]))
+
+
+def save_block_index_file(file_path: str, index: list) -> None:
+    """ Save the block index next to the file it indexes as a binary index file, see `read_block_index_file` """
+    start_bits, end_bits, first_rows = zip(*index)
+    save_index_file(f'{file_path}{BLOCK_INDEX_SUFFIX}', {"start_bit": start_bits, "end_bit": end_bits, "first_row": first_rows})
+
+
+if __name__ == "__main__":
     file_path = '/work3/s204163/wiki/wiki-revisions-dataset.bz2'
-    index = create_index_file(file_path, INDEX_ROWS_SPACING, ROWS_PER_REVISION)
 
-    # Save the index
-    with open(f'/work3/s204163/wiki/index_file{REVISIONS_PER_INDEX}', 'w') as f:
-        for line_num, byte_pos in index.items():
-            f.write(f"{line_num}, {byte_pos}\n")
+    # Save the block index next to the file it indexes, a killed job continues from the last checkpoint
+    block_index = create_block_index_file(file_path, checkpoint_path = f"{file_path}{BLOCK_INDEX_SUFFIX}{CHECKPOINT_SUFFIX}")
+    save_block_index_file(file_path, block_index)
+
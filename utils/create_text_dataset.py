@@ -1,7 +1,20 @@
+import os
 import json
+import time
 import zipfile
+from multiprocessing import Pool
+
+from utils.parallel_scan import n_available_cores, imap_bounded
+from utils.article_store import ARTICLE_INDEX_SUFFIX
 
 DELIMITER = "|å|ø|å|"  # Using |å|ø|å|, because no way it is written anywhere on wiki - hopefully
+MEMBERS_PER_TASK = 64  # Number of text.json files a worker reads at a time
+PENDING_PER_WORKER = 2 # Number of batches read ahead per worker, so only a few batches are ever in memory
+REPORT_INTERVAL = 30   # Seconds between throughput reports
+MANIFEST_SUFFIX = ".manifest.json"  # The crc and size of the zip member of every article, saved next to article_texts
+CHANGES_SUFFIX = ".changes.json"    # The ids that changed in the last refresh, saved next to article_texts
+
+_zip_file = None       # The zip file, opened once in every worker
 
 def extract_article_texts(zip_path:str) -> dict:
     """
@@ -19,16 +32,183 @@ def extract_article_texts(zip_path:str) -> dict:
                 
                 # Read the file content
                 with z.open(file_info) as file:
-                    data = json.loads(json.load(file))
-                    
                     # Use article_id as key and text as value
-                    key = data['id']
-                    text = (clean(data['title']), clean(data['text'])) # TODO: text cleaning !!!
-                    
-                    articles[key] = text
+                    key, title, text = parse_article(file.read())
+                    articles[key] = (title, text)
     return articles
 
 
+def parse_article(raw: bytes) -> tuple:
+    """ Parse the contents of a text.json file to (article_id, title, text). The files hold a json string of json, hence the two decodes """
+    data = json.loads(json.loads(raw))
+    return data['id'], clean(data['title']), clean(data['text']) # TODO: text cleaning !!!
+
+
+def _init_worker(zip_path: str) -> None:
+    global _zip_file
+    _zip_file = zipfile.ZipFile(zip_path, 'r')
+
+
+def _extract_members(names: list) -> list:
+    """ Read and parse a batch of text.json files in a worker, returns the article lines ready to be written """
+    lines = []
+    for name in names:
+        article_id, title, text = parse_article(_zip_file.read(name))
+        lines.append((name, article_id, f"{article_id}{DELIMITER}{title}{DELIMITER}{text}\n"))
+    return lines
+
+
+def extract_members(zip_path: str, members: list, n_workers: int = None):
+    """
+    Generator of (member name, article_id, line) of text.json members (zipfile.ZipInfo) of the zip file, in the given
+    order. The members are read and parsed in parallel by `n_workers` processes (all cores by default), only a few
+    batches of articles are ever in memory. Prints the throughput every 30 seconds
+    """
+    batches = [[info.filename for info in members[i:i + MEMBERS_PER_TASK]] for i in range(0, len(members), MEMBERS_PER_TASK)]
+    batch_bytes = [sum(info.file_size for info in members[i:i + MEMBERS_PER_TASK]) for i in range(0, len(members), MEMBERS_PER_TASK)]
+    total_bytes = sum(batch_bytes)
+
+    n_articles, n_bytes = 0, 0
+    n_workers = n_workers or n_available_cores()
+    start_time = last_report = time.perf_counter()
+    with Pool(n_workers, initializer=_init_worker, initargs=(zip_path,)) as pool:
+        # Keeps the order of the batches, while the workers run at most a few batches ahead
+        for size, lines in zip(batch_bytes, imap_bounded(pool, _extract_members, batches, PENDING_PER_WORKER * n_workers)):
+            yield from lines
+
+            n_articles += len(lines)
+            n_bytes += size
+            if REPORT_INTERVAL <= time.perf_counter() - last_report:
+                last_report = time.perf_counter()
+                print(_throughput(n_articles, len(members), n_bytes, total_bytes, last_report - start_time))
+
+    print(_throughput(n_articles, len(members), n_bytes, total_bytes, time.perf_counter() - start_time))
+
+
+def text_members(zip_path: str) -> list:
+    """ The text.json members of the zip file, we ignore meta.json and images """
+    with zipfile.ZipFile(zip_path, 'r') as z:
+        return [info for info in z.infolist() if info.filename.endswith('text.json')]
+
+
+def write_article_texts(zip_path: str, texts_path: str, ids_path: str, n_workers: int = None) -> int:
+    """
+    Extract the articles of the zip file straight to the article_texts and article_ids files (the same files as
+    `extract_article_texts` + saving them gives), see `extract_members`. A manifest of the crc and size of the
+    member of every article is saved next to article_texts, so `refresh_article_texts` can update the files later
+    """
+    members = text_members(zip_path)
+    info = {member.filename: member for member in members}
+    manifest = {}
+
+    with open(texts_path, 'w', encoding="utf-8") as texts_file, open(ids_path, 'w') as ids_file:
+        for name, article_id, line in extract_members(zip_path, members, n_workers):
+            texts_file.write(line)
+            ids_file.write(f"{article_id}\n")
+            manifest[name] = [info[name].CRC, info[name].file_size, article_id]
+
+    save_manifest(f"{texts_path}{MANIFEST_SUFFIX}", manifest)
+    remove_article_index(texts_path)
+    return len(manifest)
+
+
+def remove_article_index(texts_path: str) -> None:
+    """ Remove the `ArticleStore` index of article_texts after rewriting it, it is rebuilt the next time it is opened """
+    if os.path.exists(f"{texts_path}{ARTICLE_INDEX_SUFFIX}"):
+        os.remove(f"{texts_path}{ARTICLE_INDEX_SUFFIX}")
+
+
+def refresh_article_texts(zip_path: str, texts_path: str, ids_path: str, n_workers: int = None) -> dict:
+    """
+    Update article_texts and article_ids to a new snapshot of the zip file, by only extracting the members that were
+    added or changed since the last run (their crc or size differ from the manifest). Changed articles keep their line,
+    removed articles are dropped and new articles are appended. Falls back to `write_article_texts` if there is no
+    manifest yet.
+
+    Returns
+    -------
+    The ids downstream preprocessing has to recompute, {"added": [...], "changed": [...], "removed": [...]}. Also
+    saved next to article_texts as .changes.json
+    """
+    manifest_path = f"{texts_path}{MANIFEST_SUFFIX}"
+    members = text_members(zip_path)
+    if not os.path.exists(manifest_path) or not os.path.exists(texts_path):
+        write_article_texts(zip_path, texts_path, ids_path, n_workers)
+        changes = {"added": [article_id for _, _, article_id in load_manifest(manifest_path).values()], "changed": [], "removed": []}
+    else:
+        manifest = load_manifest(manifest_path)
+        current = {member.filename: member for member in members}
+
+        removed = [name for name in manifest if name not in current]
+        modified = [member for member in members if member.filename not in manifest or manifest[member.filename][:2] != [member.CRC, member.file_size]]
+
+        # The new lines of the changed articles, by the id they had before
+        new_lines = {}
+        added_lines = []
+        for name, article_id, line in extract_members(zip_path, modified, n_workers):
+            if name in manifest:
+                new_lines[manifest[name][2]] = line
+            else:
+                added_lines.append(line)
+            manifest[name] = [current[name].CRC, current[name].file_size, article_id]
+
+        removed_ids = {manifest.pop(name)[2] for name in removed}
+
+        # A member that was renamed but is the same article is removed and added, it keeps its line instead
+        for line in list(added_lines):
+            article_id = int(line[:line.index(DELIMITER)])
+            if article_id in removed_ids:
+                removed_ids.discard(article_id)
+                new_lines[article_id] = line
+                added_lines.remove(line)
+
+        changes = {
+            "added"  : [int(line[:line.index(DELIMITER)]) for line in added_lines],
+            "changed": [int(line[:line.index(DELIMITER)]) for line in new_lines.values()],
+            "removed": sorted(removed_ids),
+        }
+
+        # Patch the files, written next to the old ones first so a crash doesnt leave half a file
+        with open(texts_path, 'r', encoding="utf-8") as old_file, open(f"{texts_path}.tmp", 'w', encoding="utf-8") as texts_file, open(f"{ids_path}.tmp", 'w') as ids_file:
+            for line in old_file:
+                article_id = int(line[:line.index(DELIMITER)])
+                if article_id in removed_ids:
+                    continue
+                line = new_lines.get(article_id, line)
+                texts_file.write(line)
+                ids_file.write(f"{line[:line.index(DELIMITER)]}\n")
+
+            for line in added_lines:
+                texts_file.write(line)
+                ids_file.write(f"{line[:line.index(DELIMITER)]}\n")
+        os.replace(f"{texts_path}.tmp", texts_path)
+        os.replace(f"{ids_path}.tmp", ids_path)
+        save_manifest(manifest_path, manifest)
+        remove_article_index(texts_path)
+
+    with open(f"{texts_path}{CHANGES_SUFFIX}", 'w') as file:
+        json.dump(changes, file)
+    print(f"Added {len(changes['added'])}, changed {len(changes['changed'])} and removed {len(changes['removed'])} articles")
+    return changes
+
+
+def save_manifest(file_path: str, manifest: dict) -> None:
+    """ Save the manifest of member name : [crc, size, article_id] """
+    with open(file_path, 'w') as file:
+        json.dump(manifest, file)
+
+
+def load_manifest(file_path: str) -> dict:
+    with open(file_path, 'r') as file:
+        return json.load(file)
+
+
+def _throughput(n_articles: int, total_articles: int, n_bytes: int, total_bytes: int, seconds: float) -> str:
+    seconds = max(seconds, 1e-9)
+    return (f"Extracted {n_articles}/{total_articles} articles ({n_bytes / total_bytes * 100 if total_bytes else 100:.1f}%) in {seconds:.0f}s, "
+            f"{n_articles / seconds:.0f} articles/s, {n_bytes / seconds / 1e6:.1f} MB/s")
+
+
 def clean(text: str) -> str:
     """
     Function to clean a string of newline characters, 
@@ -39,16 +219,9 @@ def clean(text: str) -> str:
 
 if __name__ == "__main__":
     file_path = "/work3/s204163/wiki/wikipedia-good-articles.zip"
-    articles = extract_article_texts(file_path)
-
-    # Save the article texts as id, text
-    with open('/work3/s204163/wiki/article_texts', 'w') as f:
-        for article_id, (article_title, article_text) in articles.items():
-            f.write(f"{article_id}{DELIMITER}{article_title}{DELIMITER}{article_text}\n")
 
-    # Save all the ids as a "list"
-    with open('/work3/s204163/wiki/article_ids', 'w') as f:
-        for article_id, _ in articles.items():
-            f.write(f"{article_id}\n")
+    # Save the article texts as id, title, text and all the ids as a "list", streamed on all cores.
+    # On later runs (e.g. a new snapshot) only the articles that were added or changed are extracted
+    refresh_article_texts(file_path, '/work3/s204163/wiki/article_texts', '/work3/s204163/wiki/article_ids')
 
 
@@ -0,0 +1,135 @@
+import os
+import json
+
+import numpy as np
+
+from utils.id_table import IdTable
+
+# A feature file is a small header followed by the raw array, so it can be memory mapped instead of parsed:
+#   magic (7 bytes) | version (1 byte) | header size (int64) | json header, padded to 64 bytes | array (C order)
+# The header holds the shape, dtype, the method that made the array (e.g. tfidf, sbert) and the checksum of the
+# id table (see `utils/id_table.py`) the rows are aligned with
+FEATURE_MAGIC = b"WIKIFEA"
+FEATURE_VERSION = 1
+ALIGNMENT = 64
+
+FEATURES_SUFFIX = ".features"   # e.g. /work3/s204163/wiki/sbert.features
+LABELS_SUFFIX = ".labels"       # e.g. /work3/s204163/wiki/text_labels_sbert_kmeans.labels
+
+
+def save_array(file_path: str, array: np.ndarray, method: str, id_table_checksum: int, dtype = None) -> None:
+    """
+    Save an array (features, labels, ...) with a header, see `load_array`
+
+    Parameters
+    ----------
+    file_path : str
+        Path to save the array to
+    array : np.ndarray
+        The array, row i belongs to row i of the id table
+    method : str
+        What made the array, e.g. 'tfidf', 'sbert' or 'sbert_kmeans'
+    id_table_checksum : int
+        `IdTable.checksum()` of the id table the rows are aligned with
+    dtype : optional
+        The dtype to store the array as, e.g. np.float32 or np.float16. Defaults to the dtype of the array
+    """
+    array = np.ascontiguousarray(array, dtype=dtype)
+    with open(file_path, 'wb') as file:
+        _write_header(file, array.shape, array.dtype, method, id_table_checksum)
+        file.write(array.tobytes())
+
+
+def create_array(file_path: str, shape: tuple, method: str, id_table_checksum: int, dtype = np.float32) -> np.ndarray:
+    """
+    Create an array file of the given shape (zeros) and memory map it for writing, so an array that doesnt fit in
+    memory can be filled a chunk of rows at a time. Flush it when done, it can then be loaded with `load_array`
+    """
+    dtype = np.dtype(dtype)
+    with open(file_path, 'wb') as file:
+        _write_header(file, shape, dtype, method, id_table_checksum)
+        offset = file.tell()
+        file.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+    if 0 in shape:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r+', offset=offset, shape=tuple(shape))
+
+
+def _write_header(file, shape: tuple, dtype, method: str, id_table_checksum: int) -> None:
+    header = json.dumps({"shape": [int(n) for n in shape], "dtype": np.dtype(dtype).str, "method": method, "id_table_checksum": id_table_checksum}).encode("utf-8")
+
+    # Pad the header so the array starts at an aligned offset
+    offset = len(FEATURE_MAGIC) + 1 + 8 + len(header)
+    header += b" " * (-offset % ALIGNMENT)
+
+    file.write(FEATURE_MAGIC + bytes([FEATURE_VERSION]))
+    file.write(np.int64(len(header)).tobytes())
+    file.write(header)
+
+
+def read_header(file_path: str) -> dict:
+    """ Read the header of an array saved with `save_array`, the offset of the array is added as 'offset' """
+    with open(file_path, 'rb') as file:
+        magic = file.read(len(FEATURE_MAGIC) + 1)
+        if magic[:-1] != FEATURE_MAGIC:
+            raise ValueError(f"{file_path} is not a feature file, features saved as csv have to be converted with utils/feature_store.py")
+        if magic[-1] != FEATURE_VERSION:
+            raise ValueError(f"{file_path} is a feature file of version {magic[-1]}, expected version {FEATURE_VERSION}")
+
+        header_size = int(np.frombuffer(file.read(8), dtype=np.int64)[0])
+        header = json.loads(file.read(header_size))
+
+    header["offset"] = len(FEATURE_MAGIC) + 1 + 8 + header_size
+    return header
+
+
+def load_array(file_path: str, id_table_checksum: int = None) -> np.ndarray:
+    """
+    Memory map an array saved with `save_array`, nothing is read until it is used. If the checksum of an id table is
+    given it is checked against the one the array was saved with, so we never mix up rows of different runs
+    """
+    header = read_header(file_path)
+    if id_table_checksum is not None and header["id_table_checksum"] != id_table_checksum:
+        raise ValueError(f"The rows of {file_path} ({header['method']}) are not aligned with the id table, rerun preprocessing")
+
+    shape = tuple(header["shape"])
+    if 0 in shape:
+        return np.zeros(shape, dtype=header["dtype"])
+    return np.memmap(file_path, dtype=header["dtype"], mode='r', offset=header["offset"], shape=shape)
+
+
+def save_features(file_path: str, features: np.ndarray, method: str, id_table_checksum: int, dtype = np.float32) -> None:
+    """ Save a feature matrix, as float32 by default. float16 halves it again and is plenty for normalized embeddings """
+    save_array(file_path, features, method, id_table_checksum, dtype)
+
+
+def save_labels(file_path: str, labels: np.ndarray, method: str, id_table_checksum: int) -> None:
+    """ Save the cluster labels of the articles as int32 """
+    save_array(file_path, labels, method, id_table_checksum, np.int32)
+
+
+def load_features(file_path: str, id_table_checksum: int = None) -> np.ndarray:
+    """ Memory map a feature matrix saved with `save_features` """
+    return load_array(file_path, id_table_checksum)
+
+
+def load_labels(file_path: str, id_table_checksum: int = None) -> np.ndarray:
+    """ Memory map the labels saved with `save_labels` """
+    return load_array(file_path, id_table_checksum)
+
+
+if __name__ == "__main__":
+    # One time conversion of the csv features and labels made before the binary format
+    base_path = "/work3/s204163/wiki/"
+    checksum = IdTable(f"{base_path}article_ids.table").checksum()
+
+    for embedding_method in ["tfidf", "sbert"]:
+        features = np.loadtxt(f"{base_path}{embedding_method}features.csv", delimiter=",")
+        save_features(f"{base_path}{embedding_method}{FEATURES_SUFFIX}", features, embedding_method, checksum)
+
+        for cluster_method in ["kmeans", "dbscan"]:
+            if not os.path.exists(f"{base_path}text_labels_{embedding_method}_{cluster_method}.csv"):
+                continue
+            labels = np.genfromtxt(f"{base_path}text_labels_{embedding_method}_{cluster_method}.csv", dtype=np.int32, delimiter=",")
+            save_labels(f"{base_path}text_labels_{embedding_method}_{cluster_method}{LABELS_SUFFIX}", labels, f"{embedding_method}_{cluster_method}", checksum)
@@ -1,33 +1,45 @@
-import bz2
+from functools import partial
 
-from read_data import groups, parse_line
-
-# TODO: Could be parallel, would be a nice to have feature for report
+from utils.revision_filter import RevisionFilter
+from utils.parallel_scan import parallel_scan
+from utils.checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+from utils.stream_writer import MultiStreamWriter, compress_revisions
 
 NUM_REVISIONS = float(1632271984 // 14)
 
-def delete_revisions(input_file_path: str, output_file_path: str, article_ids_file_path: str) -> None:
+def delete_revisions(input_file_path: str, output_file_path: str, article_ids_file_path: str, n_workers: int = None) -> None:
+    """
+    Write the revisions of articles we have text for to a new file. The input is parsed in parallel on
+    `n_workers` cores (all of them by default), see `utils/parallel_scan.py`, and written back in order.
+    A checkpoint is saved next to the output every 10 minutes, a restarted job continues from the last one.
+    """
+    # We could add more complex filtering if we want a smaller dataset (users, time, etc.). For now just pick ids that we have good text data on
+    keep = RevisionFilter(article_ids = get_article_ids(article_ids_file_path))
 
-    # A set of ids we have good text data on
-    ids_of_text_articles = get_article_ids(article_ids_file_path)
+    # The kept revisions are compressed by the workers as independent bzip2 streams, which are written one after
+    # another. The output up to any stream is a complete .bz2 file, so a checkpoint is simply the streams so far
+    checkpoint = Checkpoint(f"{output_file_path}{CHECKPOINT_SUFFIX}", output_path = output_file_path)
+    start = checkpoint.state["revision"] if checkpoint.state else 0
+    if start:
+        print(f"Resuming from revision {start}")
 
-    with bz2.open(input_file_path, 'rt') as input_file, bz2.open(output_file_path, 'wt') as output_file:
-        
-        for i, line in enumerate(groups(input_file, 14)):
-            if i % 100000 == 0:
-                print(f"Read {i}/1632271984 ~= {i / NUM_REVISIONS * 100.0:.2f}% lines")
+    with checkpoint.open_output() as output_file:
+        writer = MultiStreamWriter(output_file, checkpoint.state["streams"], checkpoint.state["n_rows"]) if start else MultiStreamWriter(output_file)
+        for (_, end), streams in parallel_scan(input_file_path, partial(keep_revisions, keep), n_workers, start = start):
+            print(f"Read {end}/{NUM_REVISIONS:.0f} ~= {end / NUM_REVISIONS * 100.0:.2f}% revisions")
+            writer.write(streams)
 
-            if keep_revision(ids_of_text_articles, parse_line(line)):
-                output_file.write("".join(line))
+            if checkpoint.due():
+                checkpoint.save({"revision": end, **writer.state()}, output_file)
 
-            # TODO: temporary as to not run on entire dataset
-            # if 100000 < i:
-            #     break
+    # The block index of the output comes from the writer, no need to index the output afterwards
+    writer.save_index(output_file_path)
+    checkpoint.remove()
 
 
-def keep_revision(ids_of_text_articles: set, revision: dict) -> bool:
-    """ We could add more complex filtering if we want a smaller dataset. For now just pick ids that we have good text data on """
-    return revision['article_id'] in ids_of_text_articles
+def keep_revisions(keep: RevisionFilter, revisions) -> list:
+    """ Filter a chunk of revisions and compress the ones we keep to bzip2 streams. Only the REVISION line is parsed """
+    return compress_revisions("".join(revision) for revision in revisions if keep(revision[0]))
 
 
 def get_article_ids(article_ids_file_path: str) -> set:
@@ -41,5 +53,6 @@ if __name__ == "__main__":
     output_file_path = '/work3/s204163/wiki/wiki-revisions-filtered.bz2'
     article_ids_file_path = '/work3/s204163/wiki/article_ids'
 
+    # Also saves the block index of the output, so it can be scanned in parallel by graph/count_revisions.py
     delete_revisions(input_file_path, output_file_path, article_ids_file_path)
 
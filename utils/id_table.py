@@ -0,0 +1,63 @@
+import zlib
+
+import numpy as np
+
+from utils.index_file import save_index_file, load_index_file
+
+
+def save_id_table(file_path: str, article_ids: list) -> None:
+    """
+    Save the mapping between article ids and rows (the position of the article in the cleaned texts, feature
+    matrices, labels, etc.). `article_ids` has to be in row order. Every text artifact is written in the
+    same order, so this is the one place the order is defined
+    """
+    article_ids = np.asarray(article_ids, dtype=np.int64)
+    rows = np.argsort(article_ids, kind='stable')
+
+    if len(article_ids) and (np.diff(article_ids[rows]) == 0).any():
+        raise ValueError("The article ids have to be unique")
+
+    save_index_file(file_path, {"article_id": article_ids, "sorted_id": article_ids[rows], "row_of_sorted": rows})
+
+
+class IdTable:
+    def __init__(self, file_path: str):
+        """
+        Vectorized article id <-> row lookups, backed by a memory mapped table made with `save_id_table`.
+        Looking up thousands of ids is a single np.searchsorted
+
+        Examples
+        --------
+        >>> table = IdTable('/work3/s204163/wiki/article_ids.table')
+        >>> rows = table.ids_to_rows([11920088, 12345])
+        >>> table.rows_to_ids(rows)
+        """
+        self.file_path = file_path
+        index = load_index_file(file_path)
+        self.article_ids, self._sorted_ids, self._rows_of_sorted = index[:, 0], index[:, 1], index[:, 2]
+
+    def __len__(self):
+        return len(self.article_ids)
+
+    def __repr__(self):
+        return f"IdTable(file_path={self.file_path}, n_ids={len(self)})"
+
+    def ids_to_rows(self, article_ids) -> np.ndarray:
+        """ Get the rows of article ids, raises a KeyError if any of the ids arent in the table """
+        article_ids = np.asarray(article_ids, dtype=np.int64)
+        positions = np.searchsorted(self._sorted_ids, article_ids)
+
+        found = positions < len(self._sorted_ids)
+        found[found] = self._sorted_ids[positions[found]] == article_ids[found]
+        if not found.all():
+            raise KeyError(f"Article ids not in {self.file_path}: {article_ids[~found][:10].tolist()}")
+
+        return np.asarray(self._rows_of_sorted[positions])
+
+    def rows_to_ids(self, rows) -> np.ndarray:
+        """ Get the article ids of rows """
+        return np.asarray(self.article_ids[np.asarray(rows, dtype=np.int64)])
+
+    def checksum(self) -> int:
+        """ A checksum of the ids in row order, artifacts can store it to check they are aligned with the table """
+        return zlib.crc32(np.ascontiguousarray(self.article_ids).tobytes())
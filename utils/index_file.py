@@ -0,0 +1,91 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+
+# An index file is a small header followed by int64 columns, each stored contiguously so they can be memory
+# mapped and searched with np.searchsorted without ever being parsed:
+#   magic (7 bytes) | version (1 byte) | n_columns (int64) | n_entries (int64) | n_metadata (int64) |
+#   n_columns names (16 bytes each) | n_metadata (name (16 bytes), value (int64)) | columns
+# The metadata are a few named ints about the index, e.g. the size of the file it indexes. Version 1 files have no
+# metadata (and no n_metadata) and can still be read
+INDEX_MAGIC = b"WIKIIDX"
+INDEX_VERSION = 2
+COLUMN_NAME_BYTES = 16
+MAX_CACHED_INDEXES = 64     # Number of memory mapped index files kept open per process
+
+
+def save_index_file(file_path: str, columns: dict, metadata: dict = None) -> None:
+    """
+    Save an index as a binary file of named int64 columns of equal length, and optionally named int metadata
+
+    Examples
+    --------
+    >>> save_index_file('/path/to/index', {'row': [0, 700, 1400], 'byte_position': [0, 41250, 80133]})
+    """
+    metadata = metadata or {}
+    names = list(columns)
+    if any(COLUMN_NAME_BYTES < len(name.encode("ascii")) for name in names + list(metadata)):
+        raise ValueError(f"Column and metadata names can be at most {COLUMN_NAME_BYTES} characters")
+    data = np.array([np.asarray(columns[name], dtype=np.int64) for name in names], dtype=np.int64).reshape(len(names), -1)
+
+    # Written next to the old file and then moved over it, so a memory map of the old file stays valid
+    with open(f"{file_path}.tmp", 'wb') as file:
+        file.write(INDEX_MAGIC + bytes([INDEX_VERSION]))
+        file.write(np.array([*data.shape, len(metadata)], dtype=np.int64).tobytes())
+        for name in names:
+            file.write(name.encode("ascii").ljust(COLUMN_NAME_BYTES, b"\0"))
+        for name, value in metadata.items():
+            file.write(name.encode("ascii").ljust(COLUMN_NAME_BYTES, b"\0"))
+            file.write(np.int64(value).tobytes())
+        file.write(data.tobytes())
+    os.replace(f"{file_path}.tmp", file_path)
+
+
+def _read_header(file_path: str) -> tuple:
+    """ Read the header of an index file, returns (column names, n_entries, metadata, offset of the columns) """
+    with open(file_path, 'rb') as file:
+        magic = file.read(len(INDEX_MAGIC) + 1)
+        if magic[:-1] != INDEX_MAGIC:
+            raise ValueError(f"{file_path} is not an index file, indexes made before the binary format have to be recreated with utils/create_index.py")
+        if magic[-1] not in (1, INDEX_VERSION):
+            raise ValueError(f"{file_path} is an index file of version {magic[-1]}, expected version {INDEX_VERSION}")
+
+        n_columns, n_entries = (int(n) for n in np.frombuffer(file.read(16), dtype=np.int64))
+        n_metadata = int(np.frombuffer(file.read(8), dtype=np.int64)[0]) if magic[-1] == INDEX_VERSION else 0
+
+        names = [file.read(COLUMN_NAME_BYTES).rstrip(b"\0").decode("ascii") for _ in range(n_columns)]
+        metadata = {}
+        for _ in range(n_metadata):
+            name = file.read(COLUMN_NAME_BYTES).rstrip(b"\0").decode("ascii")
+            metadata[name] = int(np.frombuffer(file.read(8), dtype=np.int64)[0])
+        return names, n_entries, metadata, file.tell()
+
+
+def load_index_file(file_path: str) -> np.ndarray:
+    """
+    Memory map an index file made by `save_index_file`. Returns an int64 array of shape (n_entries, n_columns) where
+    every column is contiguous in memory. The file is only mapped once per process, later calls are free as long as
+    the file isnt rewritten (its size and modification time are part of the cache key).
+    """
+    stat = os.stat(file_path)
+    return _load_index_file(file_path, stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=MAX_CACHED_INDEXES)
+def _load_index_file(file_path: str, size: int, mtime_ns: int) -> np.ndarray:
+    names, n_entries, _, offset = _read_header(file_path)
+    if n_entries == 0 or size == offset:
+        return np.zeros((0, len(names)), dtype=np.int64)
+
+    return np.memmap(file_path, dtype=np.int64, mode='r', offset=offset, shape=(len(names), n_entries)).T
+
+
+def index_file_columns(file_path: str) -> list:
+    """ The names of the columns of an index file """
+    return _read_header(file_path)[0]
+
+
+def index_file_metadata(file_path: str) -> dict:
+    """ The metadata an index file was saved with, empty for version 1 files """
+    return _read_header(file_path)[2]
@@ -0,0 +1,207 @@
+import os
+import json
+import pickle
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+
+import pandas as pd
+
+from utils.bz2_blocks import find_blocks, decompress_blocks
+from utils.read_data import ROWS_PER_REVISION, REVISION_FIELDS
+from utils.revision_filter import RevisionFilter
+from utils.parallel_scan import n_available_cores, BLOCKS_PER_CHUNK
+from utils.filter_revisions import get_article_ids
+from utils.create_index import save_block_index_file
+from utils.stream_writer import MultiStreamWriter, compress_revisions
+from utils.checkpoint import Checkpoint, CHECKPOINT_SUFFIX
+
+STATS_SUFFIX = ".stats.json"    # The exact counts of a file are saved next to it, e.g. wiki-revisions-dataset.bz2.stats.json
+REVISION_START = b"\nREVISION "  # Only the first line of a revision starts with REVISION, the other lines have their own prefixes
+
+normalize_user_id = REVISION_FIELDS["user_id"][2]    # Strips the ip: prefix, the same user ids as `parse_fields` gives
+
+_keep = None                    # The filter, set once in every worker so it isnt sent along with every group of blocks
+
+
+def _init_worker(keep: RevisionFilter) -> None:
+    global _keep
+    _keep = keep
+
+
+def ingest_revisions(revisions: bytes, keep: RevisionFilter) -> tuple:
+    """ Filter and count complete revisions, returns the raw text of every kept revision and the article and user counters """
+    kept = []
+    article_counts = Counter()
+    user_counts = Counter()
+
+    # Split only on "\n" like `iter_lines`, str.splitlines also splits on characters like U+2028 that are in comments
+    lines = revisions.decode("utf-8").split("\n")[:-1]
+    for i in range(0, len(lines), ROWS_PER_REVISION):
+        revision_line = lines[i] + "\n"
+        _, article_id, _, _, _, _, user_id = lines[i].split(" ")
+        article_counts[int(article_id)] += 1
+        user_counts[normalize_user_id(user_id)] += 1
+        if keep(revision_line):
+            kept.append("\n".join(lines[i:i + ROWS_PER_REVISION]) + "\n")
+
+    return kept, article_counts, user_counts
+
+
+def _ingest_blocks(file_path: str, first_bit: int, blocks: list) -> tuple:
+    """
+    Decompress a group of blocks and ingest the revisions that start and end in it. A revision that is cut by the
+    start or end of the group is returned as raw bytes (head and tail), the main process glues it back together
+    """
+    first = blocks[0][0] == first_bit   # Only the first group of the file starts at the start of a revision
+    rows_per_block = []
+    data = []
+    for block in blocks:
+        block_data = b"".join(decompress_blocks(file_path, [block]))
+        rows_per_block.append(block_data.count(b"\n"))
+        data.append(block_data)
+    data = b"".join(data)
+
+    start = 0 if first else data.find(REVISION_START) + 1
+    end = data.rfind(REVISION_START) + 1
+    if (start == 0 and not first) or end <= start:
+        # No complete revision in the group, everything is passed on
+        return rows_per_block, data, None, None
+
+    # The kept revisions are compressed here as well, so the main process only has to write them
+    kept, article_counts, user_counts = ingest_revisions(data[start:end], _keep)
+    return rows_per_block, data[:start], data[end:], (compress_revisions(kept), len(kept), article_counts, user_counts)
+
+
+def ingest(input_file_path: str, output_file_path: str, counts_dir: str, keep: RevisionFilter, n_workers: int = None, blocks_per_chunk: int = BLOCKS_PER_CHUNK) -> dict:
+    """
+    Read the raw dump once and get everything the later stages need from that one decompression. Groups of bzip2
+    blocks are decompressed in parallel and in the same pass we get:
+        - the block index of the dump (saved next to it, like `utils/create_index.py` does)
+        - the kept revisions, written to `output_file_path` and indexed (like `utils/filter_revisions.py` does)
+        - exact row and revision counts (saved next to the dump as .stats.json, no more `bzcat | wc -l`)
+        - the number of revisions of every article and user (saved to `counts_dir`)
+    A checkpoint is saved next to the output every 10 minutes, a restarted job continues from the last one.
+
+    Parameters
+    ----------
+    input_file_path : str
+        Path to the raw .bz2 dump, it doesnt need an index
+    output_file_path : str
+        Path to write the kept revisions to (.bz2)
+    counts_dir : str
+        Directory to save article_counts.pickle and user_counts.pickle (pd.Series of id : number of revisions) to
+    keep : RevisionFilter
+        Which revisions to keep, see `utils/revision_filter.py`
+    n_workers : int, optional
+        Number of processes, defaults to the number of cores given to the job
+    blocks_per_chunk : int, optional
+        Number of bzip2 blocks a worker handles at a time
+
+    Returns
+    -------
+    The stats of the dump, {"n_rows": ..., "n_revisions": ..., "n_blocks": ..., "n_kept_revisions": ...}
+    """
+    blocks = find_blocks(input_file_path)
+    groups = [blocks[i:i + blocks_per_chunk] for i in range(0, len(blocks), blocks_per_chunk)]
+
+    # The kept revisions are appended to the output like in `filter_revisions`. The rest of the state is too big (or
+    # binary) for the json checkpoint, it is pickled next to it with the group it belongs to
+    checkpoint = Checkpoint(f"{output_file_path}{CHECKPOINT_SUFFIX}", output_path = output_file_path)
+    state_path = f"{checkpoint.file_path}.pickle"
+    start = checkpoint.state["group"] if checkpoint.state else 0
+    if start:
+        with open(state_path, 'rb') as file:
+            state = pickle.load(file)
+        if state["group"] != start:
+            raise ValueError(f"{state_path} is from group {state['group']} but the checkpoint is from group {start}, delete both to start over")
+        carry, rows_per_block, article_counts, user_counts = state["carry"], state["rows_per_block"], state["article_counts"], state["user_counts"]
+        n_kept = checkpoint.state["n_kept"]
+        print(f"Resuming from group {start}/{len(groups)} with {n_kept} kept revisions")
+    else:
+        carry = b""     # The revision cut by the end of the previous group
+        rows_per_block = []
+        article_counts = Counter()
+        user_counts = Counter()
+        n_kept = 0
+
+    def add(result):
+        nonlocal n_kept
+        streams, n, articles, users = result
+        writer.write(streams)
+        article_counts.update(articles)
+        user_counts.update(users)
+        n_kept += n
+
+    def add_carry(carry):
+        kept, articles, users = ingest_revisions(carry, keep)
+        add((compress_revisions(kept), len(kept), articles, users))
+
+    def save_checkpoint(group):
+        # The pickle is replaced before the checkpoint, so the checkpoint never points to a state that isnt saved
+        with open(f"{state_path}.tmp", 'wb') as file:
+            pickle.dump({"group": group, "carry": carry, "rows_per_block": rows_per_block, "article_counts": article_counts, "user_counts": user_counts}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f"{state_path}.tmp", state_path)
+        checkpoint.save({"group": group, "n_kept": n_kept, **writer.state()}, output_file)
+
+    with checkpoint.open_output() as output_file, Pool(n_workers or n_available_cores(), initializer=_init_worker, initargs=(keep,)) as pool:
+        writer = MultiStreamWriter(output_file, checkpoint.state["streams"], checkpoint.state["n_rows"]) if start else MultiStreamWriter(output_file)
+        for i, (rows, head, tail, result) in enumerate(pool.imap(partial(_ingest_blocks, input_file_path, blocks[0][0] if blocks else 0), groups[start:]), start = start):
+            rows_per_block.extend(rows)
+            carry += head
+            if result is not None:
+                # The revision cut by the previous group comes before the revisions of this group
+                if carry:
+                    add_carry(carry)
+                add(result)
+                carry = tail
+            print(f"Ingested {i + 1}/{len(groups)} groups of blocks, {sum(rows_per_block) // ROWS_PER_REVISION} revisions")
+
+            if checkpoint.due():
+                save_checkpoint(i + 1)
+
+        if carry:
+            add_carry(carry)
+    writer.save_index(output_file_path)
+
+    # The block index of the dump, the last entry marks the total number of rows (see `create_block_index_file`)
+    index = []
+    first_row = 0
+    for (start_bit, end_bit), n_rows in zip(blocks, rows_per_block):
+        index.append((start_bit, end_bit, first_row))
+        first_row += n_rows
+    end_bit = blocks[-1][1] if blocks else 0
+    index.append((end_bit, end_bit, first_row))
+    save_block_index_file(input_file_path, index)
+
+    stats = {"n_rows": first_row, "n_revisions": first_row // ROWS_PER_REVISION, "n_blocks": len(blocks), "n_kept_revisions": n_kept}
+    with open(f"{input_file_path}{STATS_SUFFIX}", 'w') as file:
+        json.dump(stats, file)
+
+    os.makedirs(counts_dir, exist_ok=True)
+    pd.Series(article_counts, dtype="int64").sort_index().to_pickle(os.path.join(counts_dir, "article_counts.pickle"))
+    pd.Series(user_counts, dtype="int64").sort_index().to_pickle(os.path.join(counts_dir, "user_counts.pickle"))
+
+    checkpoint.remove()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return stats
+
+
+def read_stats(file_path: str) -> dict:
+    """ Read the exact counts of a file saved by `ingest`, e.g. read_stats(path)['n_rows'] instead of N_ROWS """
+    with open(f"{file_path}{STATS_SUFFIX}", 'r') as file:
+        return json.load(file)
+
+
+if __name__ == "__main__":
+    input_file_path  = '/work3/s204163/wiki/wiki-revisions-dataset.bz2'
+    output_file_path = '/work3/s204163/wiki/wiki-revisions-filtered.bz2'
+    article_ids_file_path = '/work3/s204163/wiki/article_ids'
+    counts_dir = '/work3/s204163/wiki/revision-counts'
+
+    # Replaces running create_index.py, filter_revisions.py and bzcat | wc -l one after another
+    stats = ingest(input_file_path, output_file_path, counts_dir, RevisionFilter(article_ids = get_article_ids(article_ids_file_path)))
+    print(stats)
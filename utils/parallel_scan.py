@@ -0,0 +1,95 @@
+import os
+from collections import deque
+from itertools import islice
+from functools import partial
+from multiprocessing import Pool
+
+from utils.read_data import groups, read_rows_from, read_block_index_file, ROWS_PER_REVISION, BLOCK_INDEX_SUFFIX
+
+BLOCKS_PER_CHUNK = 64   # Number of bzip2 blocks (~900k uncompressed each) a worker handles at a time
+PENDING_PER_WORKER = 2  # Number of chunks per worker that are submitted or done but not yet taken by the caller
+
+_index = None           # The block index, loaded once in every worker so it isnt sent along with every chunk
+
+
+def n_available_cores() -> int:
+    """ The number of cores we were given by LSF (#BSUB -n), or all the cores of the machine if not run as a job """
+    return int(os.environ.get("LSB_DJOB_NUMPROC", os.cpu_count()))
+
+
+def imap_bounded(pool, function, tasks, max_pending: int):
+    """
+    Like pool.imap (the results in the order of the tasks), but the next task is only read from `tasks` once a
+    result is taken, so at most `max_pending` tasks and results are in memory. imap reads the whole iterator up front
+    and queues the results without a limit
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if max_pending <= len(pending):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def revision_ranges(index, blocks_per_chunk: int = BLOCKS_PER_CHUNK) -> list:
+    """
+    Split the revisions of a file into (start, end) ranges of roughly `blocks_per_chunk` blocks each. A range
+    starts at the first revision that begins after the first row of its block, so every range can be read by
+    decompressing from its own block and ranges never overlap.
+    """
+    n_revisions = int(index[-1, 2]) // ROWS_PER_REVISION
+    starts = [0] + [int(first_row) // ROWS_PER_REVISION + 1 for first_row in index[blocks_per_chunk:-1:blocks_per_chunk, 2]]
+    starts = sorted(set(min(start, n_revisions) for start in starts))
+
+    return list(zip(starts, starts[1:] + [n_revisions]))
+
+
+def _init_worker(index_path: str) -> None:
+    global _index
+    _index = read_block_index_file(index_path)
+
+
+def _scan_range(file_path: str, process, revision_range: tuple):
+    """ Read the revisions [start, end) by decompressing only from their block, and process them """
+    start, end = revision_range
+    lines = read_rows_from(file_path, start * ROWS_PER_REVISION, index = _index)
+    return process(islice(groups(lines, ROWS_PER_REVISION), end - start))
+
+
+def parallel_scan(file_path: str, process, n_workers: int = None, blocks_per_chunk: int = BLOCKS_PER_CHUNK, start: int = 0):
+    """
+    Scan a (block indexed) .bz2 revisions file on multiple cores. The file is split into chunks at bzip2 block
+    boundaries and every chunk is decompressed and handed to `process` in a worker process.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the .bz2 file, a block index has to have been made with `utils/create_index.py`
+    process : callable
+        Function taking an iterator of revisions (tuples of 14 lines, like `groups` gives) and returning
+        the result of the chunk. Has to be picklable, i.e. a module level function or a functools.partial of one
+    n_workers : int, optional
+        Number of processes, defaults to the number of cores given to the job
+    blocks_per_chunk : int, optional
+        Number of bzip2 blocks per chunk
+    start : int, optional
+        The revision to start from, e.g. the last revision range of a checkpoint. Everything before it is skipped
+
+    Returns
+    -------
+    Generator of (revision_range, result) of every chunk, in the order of the file
+
+    Examples
+    --------
+    >>> for (start, end), n in parallel_scan('/path/to/dump.bz2', count_revisions):
+    ...     print(f"{start}-{end}: {n}")
+    """
+    index_path = f"{file_path}{BLOCK_INDEX_SUFFIX}"
+    ranges = [(max(first, start), end) for first, end in revision_ranges(read_block_index_file(index_path), blocks_per_chunk) if start < end]
+
+    # Every worker memory maps the index itself, instead of getting a copy of it
+    n_workers = n_workers or n_available_cores()
+    with Pool(n_workers, initializer=_init_worker, initargs=(index_path,)) as pool:
+        # Keeps the order of the chunks, the workers only run a few chunks ahead of a slow caller
+        yield from zip(ranges, imap_bounded(pool, partial(_scan_range, file_path, process), ranges, PENDING_PER_WORKER * n_workers))
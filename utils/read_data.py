@@ -1,22 +1,29 @@
-from itertools import zip_longest
+from itertools import zip_longest, islice
 from datetime import datetime
-from random import randint
+from random import randint, sample, random as uniform
+from math import exp, log, floor
+import os
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 import bz2
 from tqdm import tqdm
 
+from utils.bz2_blocks import decompress_blocks, iter_lines
+from utils.index_file import load_index_file
+
 # Prefixes of the properties, see: https://snap.stanford.edu/data/wiki-meta.html
 PREFIXES = ["CATEGORY", "IMAGE ", "MAIN", "TALK", "USER ", "USER_TALK", "OTHER", "EXTERNAL", "TEMPLATE", "COMMENT", "MINOR", "TEXTDATA"]
 DELIMITER = "|å|ø|å|" # Using |å|ø|å| because no way it is anywhere in the dataset - right?, update: there isnt
 
 ROWS_PER_REVISION = 14                      # The number of rows in a single revision object, should never change
-REVISIONS_PER_INDEX = 50                    # How many revisions should there be between indexing
 N_ROWS = 1632271984                         # The number of rows in the .bz2 file, takes hours to calculate
 N_REVISIONS = N_ROWS // ROWS_PER_REVISION   # The number of revisions, each revision is 14 rows long
+BLOCK_INDEX_SUFFIX = ".blocks"              # The block index of a file is saved next to it, e.g. wiki-revisions-dataset.bz2.blocks
 
 
-def read_revisions(file_path: str, N: int = None, start: int = None, end: int = None, random: bool = False, tqdm_disable : bool = True) -> pd.DataFrame:
+def read_revisions(file_path: str, N: int = None, start: int = None, end: int = None, random: bool = False, reservoir: bool = False, chunksize: int = None, vocabularies: dict = None, tqdm_disable : bool = True) -> pd.DataFrame:
     """
     Read and parse N lines of a (large) bzip2 file on the format given in Wikipedia Edits dataset 
     seen in: https://snap.stanford.edu/data/wiki-meta.html
@@ -34,6 +41,17 @@ def read_revisions(file_path: str, N: int = None, start: int = None, end: int =
         `start` is not provided.
     random : bool, default False
         Will read `N` random entries from the file if true.
+    reservoir : bool, default False
+        Sample the `N` random entries with reservoir sampling in a single pass over the file,
+        which doesnt need to know the number of revisions or have a block index.
+    chunksize : int, optional
+        Instead of one DataFrame, return a generator of (DataFrame, list values) of at most `chunksize`
+        revisions with compact dtypes, so the file can be processed in a fixed amount of memory. Reads the
+        whole file if neither `N` nor `start` and `end` are given. Cant be used with `random`.
+        See `compact_revisions`.
+    vocabularies : dict, optional
+        Only with `chunksize`. Dictionary of domain : `utils.vocabulary.Vocabulary` used to store
+        user ids, usernames, titles, categories and links as int32 ids, see `compact_revisions`.
 
     Returns
     -------
@@ -62,12 +80,26 @@ def read_revisions(file_path: str, N: int = None, start: int = None, end: int =
 
     >>> read_revisions('/path/to/dump.bz2', N=5, random=True) # Returns a DataFrame with 5 random revision entries.
 
+    >>> read_revisions('/path/to/dump.bz2', N=5, random=True, reservoir=True) # Same, in a single pass without an index.
+
+    >>> for df, values in read_revisions('/path/to/dump.bz2', chunksize=100_000): # Process the whole file 100k revisions at a time.
+    ...     df.groupby('article_id').size()
+
     Notes
     -----
-    For `random` access and access between `start` and `end` a index file has already
-    been created and will be used to significantly speed up look up.
+    For `random` access and access between `start` and `end` a block index file has already
+    been created (see `utils/create_index.py`) and will be used to jump straight to the
+    compressed block holding the revision, instead of decompressing the file from the start.
+    Random revisions are returned in the order they are in the file. If there is no block
+    index, random revisions are read with reservoir sampling.
     """
-    if random and N:
+    if chunksize and random:
+        raise ValueError("chunksize cant be used with random, random revisions are read all at once")
+    if chunksize:
+        return _read_revisions_chunked(file_path, chunksize, N, start, end, vocabularies, tqdm_disable = tqdm_disable)
+    elif random and N:
+        if reservoir or not os.path.exists(f"{file_path}{BLOCK_INDEX_SUFFIX}"):
+            return _read_revisions_reservoir(file_path, N, tqdm_disable = tqdm_disable)
         return _read_revisions_random(file_path, N, tqdm_disable = tqdm_disable)
     elif start and end:
         return _read_revisions_between(file_path, start, end, tqdm_disable = tqdm_disable)
@@ -77,6 +109,119 @@ def read_revisions(file_path: str, N: int = None, start: int = None, end: int =
         raise Exception("Error: pass at least N or start+end")
     
 
+def _read_revisions_chunked(file_path: str, chunksize: int, N: int = None, start: int = None, end: int = None, vocabularies: dict = None, tqdm_disable: bool = True):
+    """ """
+    if start and end:
+        lines = read_rows_from(file_path, start * ROWS_PER_REVISION)
+        revisions = islice(groups(lines, 14), end - start)
+        yield from _compact_chunks(revisions, chunksize, end - start, vocabularies, tqdm_disable)
+    else:
+        with bz2.open(file_path, 'rt') as file:
+            revisions = islice(groups(file, 14), N)
+            yield from _compact_chunks(revisions, chunksize, N, vocabularies, tqdm_disable)
+
+
+def _compact_chunks(revisions, chunksize: int, total: int = None, vocabularies: dict = None, tqdm_disable: bool = True):
+    """ Parse revisions `chunksize` at a time into compact DataFrames and their list values """
+    with tqdm(total=total, disable=tqdm_disable) as progress:
+        while chunk := list(parse_fields(islice(revisions, chunksize))):
+            yield compact_revisions(chunk, vocabularies)
+            progress.update(len(chunk))
+
+
+LIST_COLUMNS = ["category", "main_linked", "other_linked"]     # The set columns, stored as offsets into flat values
+
+# The vocabulary domain of every string column, links of both kinds share a domain
+VOCABULARY_DOMAINS = {"user_id": "user_id", "username": "username", "article_title": "article_title", "category": "category", "main_linked": "link", "other_linked": "link"}
+
+
+def compact_revisions(revisions: list, vocabularies: dict = None) -> tuple:
+    """
+    Make a memory lean DataFrame of revisions, as tuples of all the fields given by `parse_fields`. Compared to
+    `read_revisions` ids are int32, usernames, user ids and titles are categorical, and the sets of categories
+    and links are not stored per row. Instead every list column L has the columns L_start and L_end, that are
+    offsets into a flat categorical array of all its values. These arrays are returned next to the DataFrame as
+    a dict of column : values, i.e. (df, values). Use `list_values` to get them and `concat_compact` to
+    concatenate chunks. If `vocabularies` (domain : `utils.vocabulary.Vocabulary`) are given, all the strings
+    but the comment are int32 ids of the vocabulary of their domain instead, so they are the same ids across
+    chunks and files.
+    """
+    columns = dict(zip(REVISION_FIELDS, zip(*revisions))) if revisions else {field: () for field in REVISION_FIELDS}
+
+    def strings(column, values):
+        if vocabularies is None:
+            return pd.Categorical(values)
+        return vocabularies[VOCABULARY_DOMAINS[column]].encode(values)
+
+    df = pd.DataFrame({
+        "article_id"    : np.array(columns["article_id"], dtype=np.int32),
+        "revision_id"   : np.array(columns["revision_id"], dtype=np.int32),
+        "user_id"       : strings("user_id", columns["user_id"]),
+        "article_title" : strings("article_title", columns["article_title"]),
+        "timestamp"     : pd.to_datetime(pd.Series(columns["timestamp"], dtype=object)),
+        "username"      : strings("username", columns["username"]),
+        "comment"       : pd.Series(columns["comment"], dtype=object),
+        "minor"         : np.array(columns["minor"], dtype=bool),
+        "num_words"     : np.array(columns["num_words"], dtype=np.int32),
+    })
+
+    values = {}
+    for column in LIST_COLUMNS:
+        lengths = np.fromiter((len(column_values) for column_values in columns[column]), dtype=np.int64, count=len(df))
+        ends = np.cumsum(lengths)
+        df[f"{column}_start"] = ends - lengths
+        df[f"{column}_end"] = ends
+        values[column] = strings(column, [value for column_values in columns[column] for value in column_values])
+
+    return df, values
+
+
+def concat_compact(chunks) -> tuple:
+    """
+    Concatenate compact chunks (df, values) as given by `read_revisions(..., chunksize=...)` into one (df, values),
+    the offsets of the list columns are moved to point into the concatenated values. The index is reset
+    """
+    chunks = list(chunks)
+    frames = []
+    shifts = dict.fromkeys(LIST_COLUMNS, 0)
+    for df, chunk_values in chunks:
+        df = df.copy()
+        for column in LIST_COLUMNS:
+            df[f"{column}_start"] += shifts[column]
+            df[f"{column}_end"] += shifts[column]
+            shifts[column] += len(chunk_values[column])
+        frames.append(df)
+
+    values = {}
+    for column in LIST_COLUMNS:
+        column_values = [chunk_values[column] for _, chunk_values in chunks]
+        if column_values and isinstance(column_values[0], pd.Categorical):
+            values[column] = union_categoricals(column_values)
+        else:
+            values[column] = np.concatenate(column_values) if column_values else np.zeros(0, dtype=np.int32)
+
+    # Categorical columns with different categories per chunk are unioned too, instead of becoming object
+    df = pd.concat(frames, ignore_index=True) if frames else compact_revisions([])[0]
+    for column in ["user_id", "article_title", "username"]:
+        if frames and isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            df[column] = union_categoricals([frame[column] for frame in frames])
+    return df, values
+
+
+def list_values(df: pd.DataFrame, values: dict, column: str) -> pd.DataFrame:
+    """
+    Get a list column of a compact DataFrame (see `compact_revisions`) in long format; one row per value with the
+    index of the revision it belongs to. The DataFrame can be filtered or sliced, the offsets stay valid.
+    e.g. list_values(df, values, 'category')['value'].value_counts()
+    """
+    starts, ends = df[f"{column}_start"].to_numpy(), df[f"{column}_end"].to_numpy()
+    lengths = ends - starts
+
+    # The position of every value in the flat array, for the rows that are still in the DataFrame
+    positions = np.repeat(ends - np.cumsum(lengths), lengths) + np.arange(lengths.sum())
+    return pd.DataFrame({"revision": np.repeat(df.index.to_numpy(), lengths), "value": values[column][positions]})
+
+
 def _read_revisions_from_start(file_path: str, N: int = None, tqdm_disable : bool = True) -> pd.DataFrame:
     """ """
     with bz2.open(file_path, 'rt') as file:
@@ -94,60 +239,79 @@ def _read_revisions_from_start(file_path: str, N: int = None, tqdm_disable : boo
 
 def _read_revisions_between(file_path: str, start: int = None, end: int = None, tqdm_disable: bool = True) -> pd.DataFrame:
     """ """
-    with bz2.open(file_path, 'rt') as file:
-        revisions = []
-
-        # Get the position of the index 
-        index = read_index_file(f"/work3/s204163/wiki/index_file{REVISIONS_PER_INDEX}") # TODO: Move elsewhere
-        index_number, index_byte_position = byte_position_of_closest_index(index, start)
+    revisions = []
 
-        # Go to the location of the closest index number
-        file.seek(index_byte_position)
+    # Jump to the block holding the first revision and read from there
+    lines = read_rows_from(file_path, start * ROWS_PER_REVISION)
 
-        # There are EXACTLY 14 fields in every revision, we group / bundle them together in a tuple for speed
-        for i, line in tqdm(enumerate(groups(file, 14), start = index_number), total=(end-start), disable=tqdm_disable):
-            if i < start:
-                continue
-            if end <= i:
-                break
+    # There are EXACTLY 14 fields in every revision, we group / bundle them together in a tuple for speed
+    for line in tqdm(islice(groups(lines, 14), end - start), total=(end-start), disable=tqdm_disable):
+        revisions.append(parse_line(line))
 
-            revisions.append(parse_line(line))
-        
-        return pd.DataFrame(revisions)
+    return pd.DataFrame(revisions)
 
 
-# OBS OBS OBS TODO: Takes 90 seconds to grab 10 random revisions, should be revised to be faster
 def _read_revisions_random(file_path: str, N: int = None, tqdm_disable: bool = True) -> pd.DataFrame:
-    """ """
-    index = read_index_file(f"/work3/s204163/wiki/index_file{REVISIONS_PER_INDEX}") # TODO: Move elsewhere
-    n_indices = len(index)
+    """
+    Draw N distinct revision numbers up front and read them in sorted order, so the file is only ever read
+    forwards. Jumps to the block of the next revision if it is further ahead than the next block, otherwise
+    just keeps reading - i.e. few samples cost a block each, many samples cost a single pass over the file
+    """
+    index = read_block_index_file(f"{file_path}{BLOCK_INDEX_SUFFIX}")
+    n_revisions = int(index[-1, 2]) // ROWS_PER_REVISION
+    targets = sorted(sample(range(n_revisions), min(N, n_revisions)))
     revisions = []
 
-    with bz2.open(file_path, 'rt') as file:
-        for _ in tqdm(range(N), disable=tqdm_disable):
-            random_index = randint(0, n_indices - 1)
-            random_offset = randint(0, REVISIONS_PER_INDEX)
+    lines, current_row = None, None
+    for target in tqdm(targets, disable=tqdm_disable):
+        target_row = target * ROWS_PER_REVISION
+
+        if lines is None or block_of_row(index, current_row) + 1 < block_of_row(index, target_row):
+            lines = read_rows_from(file_path, target_row, index = index)
+        else:
+            next(islice(lines, target_row - current_row, target_row - current_row), None) # Skip ahead to the target
 
-            # Get the position of the index and go to the byte location in the file
-            _, index_byte_position = byte_position_of_closest_index(index, random_index)
-            file.seek(index_byte_position)
+        revisions.append(parse_line(next(groups(lines, 14))))
+        current_row = target_row + ROWS_PER_REVISION
 
-            # There are EXACTLY 14 fields in every revision, we group / bundle them together in a tuple for speed
-            for i, line in enumerate(groups(file, 14)):
+    return pd.DataFrame(revisions)
 
-                # If we found the revision, save and move on
-                if i == random_offset:
-                    revisions.append(parse_line(line))
+
+def _read_revisions_reservoir(file_path: str, N: int = None, tqdm_disable: bool = True) -> pd.DataFrame:
+    """
+    Sample N random revisions in a single pass without knowing how many revisions there are, using
+    reservoir sampling (Algorithm L, see: https://en.wikipedia.org/wiki/Reservoir_sampling#Optimal:_Algorithm_L).
+    Only the sampled revisions are parsed, the skipped ones are never looked at.
+    """
+    with bz2.open(file_path, 'rt') as file:
+        revisions = groups(file, 14)
+
+        # Fill the reservoir with the first N revisions, (position, revision) so we can return them in file order
+        reservoir = list(enumerate(islice(revisions, N)))
+        position = len(reservoir) - 1
+
+        # 1 - uniform() is in (0, 1] so the log is always defined
+        w = exp(log(1 - uniform()) / N)
+        with tqdm(disable=tqdm_disable) as progress:
+            while True:
+                skip = floor(log(1 - uniform()) / log(1 - w)) if w < 1 else 0
+                revision = next(islice(revisions, skip, None), None)
+                if revision is None:
                     break
-        
-        return pd.DataFrame(revisions)
+
+                position += skip + 1
+                reservoir[randint(0, N - 1)] = (position, revision)
+                w *= exp(log(1 - uniform()) / N)
+                progress.update(skip + 1)
+
+    return pd.DataFrame([parse_line(revision) for _, revision in sorted(reservoir)])
 
 
 def parse_line(line: tuple) -> dict:
     """ Parse a single line (a tuple) into a dictionary"""
     # Split the line and revision-field for at least a bit of readability
     revision, category, _image, main, _talk, _user, _user_talk, other, _external, _template, comment, minor, textdata, _ = line
-    revision_tag, article_id, revision_id, article_title, timestamp, username, user_id = revision.split(" ")
+    revision_tag, article_id, revision_id, article_title, timestamp, username, user_id = revision.rstrip("\n").split(" ")
     
     assert revision_tag == "REVISION" # Sanity check
 
@@ -168,6 +332,84 @@ def parse_line(line: tuple) -> dict:
     }
 
 
+# Where every field of a revision is, as (line number in the revision, position where the value starts, parser).
+# The revision line is split on spaces, for it the position is the index in the split line instead
+REVISION_FIELDS = {
+    "article_id"    : (0, 1, int),
+    "revision_id"   : (0, 2, int),
+    "user_id"       : (0, 6, lambda value: value.split(":")[-1]),
+    "article_title" : (0, 3, str),
+    "timestamp"     : (0, 4, lambda value: datetime.fromisoformat(value.rstrip("Z"))),
+    "username"      : (0, 5, lambda value: value.split(":")[-1]),
+    "category"      : (1, len("CATEGORY "), lambda value: set(value.split())),
+    "main_linked"   : (3, len("MAIN "), lambda value: set(value.split())),
+    "other_linked"  : (7, len("OTHER "), lambda value: set(value.split())),
+    "comment"       : (10, len("COMMENT "), lambda value: value.removesuffix("\n")),
+    "minor"         : (11, len("MINOR "), lambda value: value[0] == "1"),
+    "num_words"     : (12, len("TEXTDATA "), int),
+}
+
+
+def iter_revisions(file_path: str, fields: list = None, N: int = None, where = None):
+    """
+    Lazily read the revisions of a .bz2 file, parsing only the given fields. Much faster than `read_revisions`
+    when only a few fields are needed, e.g. the graph only needs the article and user ids.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the .bz2 compressed Wikipedia revisions file.
+    fields : list[str], optional
+        The fields to parse, see `read_revisions` for the names. Defaults to all the fields
+    N : int, optional
+        Number of revisions to read, defaults to all of them
+    where : callable, optional
+        Only keep revisions for which where(revision_line) is True, e.g. a `utils.revision_filter.RevisionFilter`.
+        It is checked on the REVISION line before anything is parsed, `N` counts the revisions that are kept
+
+    Returns
+    -------
+    Generator of tuples with the values of `fields`, in that order
+
+    Examples
+    --------
+    >>> for article_id, user_id in iter_revisions('/path/to/dump.bz2', fields=['article_id', 'user_id']):
+    ...     print(article_id, user_id)
+
+    >>> iter_revisions('/path/to/dump.bz2', fields=['user_id'], where=RevisionFilter(article_ids=[12, 290]))
+    """
+    with bz2.open(file_path, 'rt') as file:
+        revisions = groups(file, ROWS_PER_REVISION) if where is None else iter_kept_revisions(file, where)
+        yield from parse_fields(islice(revisions, N), fields)
+
+
+def iter_kept_revisions(lines, keep):
+    """
+    Generator of the revisions (tuples of 14 lines, like `groups` gives) where keep(revision_line) is True, from an
+    iterator of lines. Only the first line is looked at, the other 13 lines of rejected revisions are skipped
+    """
+    lines = iter(lines)
+    for revision_line in lines:
+        if keep(revision_line):
+            yield (revision_line, *islice(lines, ROWS_PER_REVISION - 1))
+        else:
+            next(islice(lines, ROWS_PER_REVISION - 1, ROWS_PER_REVISION - 1), None)
+
+
+def parse_fields(revisions, fields: list = None):
+    """
+    Generator parsing only the given fields of revisions (tuples of 14 lines, as given by `groups`). The
+    position of every field in the revision is fixed, so instead of checking prefixes we cut the value out
+    """
+    fields = list(REVISION_FIELDS) if fields is None else fields
+    parsers = [REVISION_FIELDS[field] for field in fields]
+    split_revision_line = any(line_number == 0 for line_number, _, _ in parsers)
+
+    for lines in revisions:
+        revision = lines[0].rstrip("\n").split(" ") if split_revision_line else None
+        yield tuple(parse(revision[position]) if line_number == 0 else parse(lines[line_number][position:]) for line_number, position, parse in parsers)
+
+
 # Cheeky function shamelessly stolen from: https://stackoverflow.com/a/312644
 def groups(iterable, n, padvalue=None):
     """grouper('abcdefg', 3, 'x') --> ('a','b','c'), ('d','e','f'), ('g','x','x')"""
@@ -185,35 +427,36 @@ def strip_prefix(text, prefixes):
     return text
 
 
-# https://stackoverflow.com/a/51980706
-def round_down(x, k=3):
+def read_block_index_file(file_path: str) -> np.ndarray:
     """
-    Round down to nearest 1000. We want to get the closest PRIOR index location, this is useful for that
-    e.g. round_down(1900) --> 1000
+    Read the block index of a .bz2 file as an array of (start_bit, end_bit, first_row), see `utils/create_index.py`.
+    The file is memory mapped once per process, so this is free to call for every read
     """
-    n = 10**k
-    return x // n * n
+    return load_index_file(file_path)
 
 
-def byte_position_of_closest_index(index: dict, current_position: int) -> int:
+def read_rows_from(file_path: str, row: int, index: np.ndarray = None):
     """
-    Get the byte position of the closest prior index position. i.e. if we are in row 1200 our closest index is in
-    row 1000. We want to get the index number and its byte position in the file.
+    Lazily iterate the lines of a .bz2 file starting at `row`. Uses the block index to find the last block
+    starting before the row and only decompresses from that block and onwards.
     """
-    index_number = round_down(current_position)
-    index_byte_position = index[index_number]
+    if index is None:
+        index = read_block_index_file(f"{file_path}{BLOCK_INDEX_SUFFIX}")
+    block = block_of_row(index, row)
+    rows_to_skip = row - int(index[block, 2])
 
-    return (index_number, index_byte_position)
+    # The first (possibly partial) line of the block belongs to row first_rows[block], skip up to the row we want
+    blocks = zip(index[block:-1, 0], index[block:-1, 1])
+    lines = iter_lines(decompress_blocks(file_path, blocks))
+    return islice(lines, rows_to_skip, None)
 
 
-def read_index_file(file_path: str) -> dict:
-    """ Read the index file for the revisions """
-    index = {}
-    with open(file_path, 'r') as file:
-        for line in file:
-            row_number, byte_position = map(int, line.strip().split(', '))
-            index[row_number] = byte_position
-    return index
+def block_of_row(index: np.ndarray, row: int) -> int:
+    """
+    The number of the block to start decompressing from to read the row. A block can start in the middle of a row,
+    so it is the last block with strictly fewer rows before it
+    """
+    return max(int(np.searchsorted(index[:-1, 2], row, side='left')) - 1, 0)
 
 
 def read_article_ids_file(file_path: str, N: int = None) -> dict:
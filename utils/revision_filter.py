@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import numpy as np
+
+LARGE_ID_SET = 100_000      # Sets of article ids larger than this are stored as a bitmap instead of a Python set
+
+
+class RevisionFilter:
+    def __init__(self, article_ids: list = None, user_ids: list = None, start_time = None, end_time = None, anonymous: bool = None):
+        """
+        A filter on revisions that is evaluated on the raw REVISION line alone, i.e. before anything else of the
+        revision is parsed. Every given condition has to hold for a revision to be kept.
+
+        Parameters
+        ----------
+        article_ids : list[int], optional
+            Keep revisions of these articles. Large sets are stored as a bitmap of the ids
+        user_ids : list[str], optional
+            Keep revisions by these users, ids of registered users and ips of anonymous users (without ip:)
+        start_time : datetime or str, optional
+            Keep revisions made at or after this time
+        end_time : datetime or str, optional
+            Keep revisions made before this time
+        anonymous : bool, optional
+            Keep only revisions by anonymous (ip) users if True, or only registered users if False
+
+        Examples
+        --------
+        >>> keep = RevisionFilter(article_ids=[12, 290], start_time='2005-01-01', anonymous=False)
+        >>> keep("REVISION 12 3854 Anarchism 2006-08-28T14:11:16Z SmackBot 433328\\n") # --> True
+        """
+        self.article_ids = None
+        if article_ids is not None:
+            article_ids = np.unique(np.asarray(list(article_ids), dtype=np.int64))
+            if len(article_ids) <= LARGE_ID_SET:
+                self.article_ids = frozenset(article_ids.tolist())
+            else:
+                # One bit per possible id, 30M article ids fit in 4MB
+                bits = np.zeros(article_ids[-1] + 1, dtype=bool)
+                bits[article_ids] = True
+                self.article_ids = np.packbits(bits, bitorder='little').tobytes()
+
+        self.user_ids = None if user_ids is None else frozenset(user_ids)
+
+        # The timestamps are ISO 8601 strings of equal length, so comparing the strings is comparing the times
+        self.start_time = None if start_time is None else _iso_timestamp(start_time)
+        self.end_time = None if end_time is None else _iso_timestamp(end_time)
+        self.anonymous = anonymous
+
+    def __repr__(self):
+        return f"RevisionFilter(article_ids={self.article_ids is not None}, user_ids={self.user_ids is not None}, start_time={self.start_time}, end_time={self.end_time}, anonymous={self.anonymous})"
+
+    def _has_article(self, article_id: int) -> bool:
+        if isinstance(self.article_ids, frozenset):
+            return article_id in self.article_ids
+        byte = article_id >> 3
+        return byte < len(self.article_ids) and (self.article_ids[byte] >> (article_id & 7)) & 1 == 1
+
+    def __call__(self, revision_line: str) -> bool:
+        """ Check if the revision with this REVISION line should be kept """
+        _, article_id, _, _, timestamp, _, user_id = revision_line.rstrip("\n").split(" ")
+
+        if self.article_ids is not None and not self._has_article(int(article_id)):
+            return False
+        if self.start_time is not None and timestamp < self.start_time:
+            return False
+        if self.end_time is not None and self.end_time <= timestamp:
+            return False
+        if self.anonymous is not None and user_id.startswith("ip:") != self.anonymous:
+            return False
+        if self.user_ids is not None and user_id.split(":")[-1] not in self.user_ids:
+            return False
+        return True
+
+
+def _iso_timestamp(time) -> str:
+    """ Format a time like the timestamps of the dump, e.g. 2006-08-28T14:11:16Z """
+    time = datetime.fromisoformat(time) if isinstance(time, str) else time
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
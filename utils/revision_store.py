@@ -0,0 +1,219 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from utils.read_data import parse_line
+from utils.parallel_scan import parallel_scan
+
+CHUNK_SIZE = 1_000_000      # Number of revisions in a chunk, every chunk has its own zone map
+META_FILE = "meta.json"
+
+# The on disk type of every field of a revision. Strings and lists of strings are stored as an int64 array of
+# offsets into a uint8 array of utf-8 values. The lists never hold spaces, so they are stored space separated
+NUMERIC_COLUMNS = {
+    "article_id"  : "int32",
+    "revision_id" : "int64",
+    "timestamp"   : "datetime64[s]",
+    "minor"       : "bool",
+    "num_words"   : "int32",
+}
+STRING_COLUMNS = ["user_id", "article_title", "username", "comment"]
+LIST_COLUMNS = ["category", "main_linked", "other_linked"]
+COLUMNS = ["article_id", "revision_id", "user_id", "article_title", "timestamp", "username", "category", "main_linked", "other_linked", "comment", "minor", "num_words"]
+
+
+def write_revision_store(revisions, path: str, chunk_size: int = CHUNK_SIZE) -> None:
+    """
+    Convert revisions (as returned by `read_revisions`) to a columnar store on disk, where every field is a
+    flat binary file that can be memory mapped. For every chunk of `chunk_size` revisions the min/max article
+    id and timestamp is saved (a zone map) so queries can skip the chunks that cant hold any matches.
+
+    Parameters
+    ----------
+    revisions : pd.DataFrame or iterable of pd.DataFrame
+        The revisions, can be given in parts so the whole dataset never has to be in memory
+    path : str
+        Directory to write the store to
+    chunk_size : int, optional
+        Max number of revisions in a chunk
+
+    Examples
+    --------
+    >>> write_revision_store(read_revisions('/path/to/dump.bz2', N=1000), '/path/to/store')
+    >>> RevisionStore('/path/to/store').query(article_ids=[12, 290])
+    """
+    if isinstance(revisions, pd.DataFrame):
+        revisions = [revisions]
+
+    os.makedirs(path, exist_ok=True)
+    files = {column: open(os.path.join(path, f"{column}.bin"), 'wb') for column in NUMERIC_COLUMNS}
+    for column in STRING_COLUMNS + LIST_COLUMNS:
+        files[column] = open(os.path.join(path, f"{column}.bin"), 'wb')
+        files[f"{column}.offsets"] = open(os.path.join(path, f"{column}.offsets.bin"), 'wb')
+
+    n_rows = 0
+    chunks = []
+    string_sizes = {column: 0 for column in STRING_COLUMNS + LIST_COLUMNS}
+
+    # Every string column starts with a 0 offset, so the n'th string is data[offsets[n]:offsets[n+1]]
+    for column in string_sizes:
+        files[f"{column}.offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+
+    try:
+        for df in revisions:
+            for chunk_start in range(0, len(df), chunk_size):
+                chunk = df.iloc[chunk_start:chunk_start + chunk_size]
+                if len(chunk) == 0:
+                    continue
+
+                for column, dtype in NUMERIC_COLUMNS.items():
+                    files[column].write(np.asarray(chunk[column], dtype=dtype).tobytes())
+
+                for column in STRING_COLUMNS + LIST_COLUMNS:
+                    values = chunk[column] if column in STRING_COLUMNS else chunk[column].map(lambda words: " ".join(sorted(words)))
+                    encoded = [value.encode("utf-8") for value in values]
+                    offsets = string_sizes[column] + np.cumsum([len(value) for value in encoded], dtype=np.int64)
+
+                    files[column].write(b"".join(encoded))
+                    files[f"{column}.offsets"].write(offsets.tobytes())
+                    string_sizes[column] = int(offsets[-1])
+
+                # The zone map of the chunk
+                timestamps = np.asarray(chunk["timestamp"], dtype="datetime64[s]").astype(np.int64)
+                chunks.append({
+                    "start"         : n_rows,
+                    "end"           : n_rows + len(chunk),
+                    "min_article_id": int(chunk["article_id"].min()),
+                    "max_article_id": int(chunk["article_id"].max()),
+                    "min_timestamp" : int(timestamps.min()),
+                    "max_timestamp" : int(timestamps.max()),
+                })
+                n_rows += len(chunk)
+    finally:
+        for file in files.values():
+            file.close()
+
+    with open(os.path.join(path, META_FILE), 'w') as file:
+        json.dump({"n_rows": n_rows, "numeric_columns": NUMERIC_COLUMNS, "string_columns": STRING_COLUMNS, "list_columns": LIST_COLUMNS, "chunks": chunks}, file)
+
+
+class RevisionStore:
+    def __init__(self, path: str):
+        """
+        Read only access to a columnar revision store made with `write_revision_store`. All columns are
+        memory mapped, so opening the store is instant and only the parts of the files that are queried are
+        ever read from disk.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the store
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as file:
+            self.meta = json.load(file)
+        self.n_rows = self.meta["n_rows"]
+        self.chunks = self.meta["chunks"]
+        self._columns = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def __repr__(self):
+        return f"RevisionStore(path={self.path}, n_rows={self.n_rows}, n_chunks={len(self.chunks)})"
+
+    def _memmap(self, file_name: str, dtype: str) -> np.ndarray:
+        """ Memory map a column file, opened once and kept around. Empty files cant be memory mapped """
+        if file_name not in self._columns:
+            file_path = os.path.join(self.path, file_name)
+            self._columns[file_name] = np.memmap(file_path, dtype=dtype, mode='r') if os.path.getsize(file_path) else np.zeros(0, dtype=dtype)
+        return self._columns[file_name]
+
+    def column(self, column: str, start: int = 0, end: int = None):
+        """ Get the rows [start, end) of a column, numeric columns are returned as (memory mapped) numpy arrays and strings as lists """
+        end = self.n_rows if end is None else end
+        if column in self.meta["numeric_columns"]:
+            return self._memmap(f"{column}.bin", self.meta["numeric_columns"][column])[start:end]
+
+        offsets = self._memmap(f"{column}.offsets.bin", "int64")[start:end + 1]
+        data = self._memmap(f"{column}.bin", "uint8")[offsets[0]:offsets[-1]].tobytes() if end > start else b""
+        offsets = offsets - offsets[0]
+        strings = [data[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+        if column in self.meta["list_columns"]:
+            return [set(string.split()) for string in strings]
+        return strings
+
+    def matching_chunks(self, article_ids: list = None, start_time = None, end_time = None) -> list:
+        """ Use the zone maps to find the chunks that can hold revisions of the articles and in the time range [start_time, end_time) """
+        article_ids = None if article_ids is None else np.asarray(list(article_ids))
+        start_time = None if start_time is None else np.datetime64(start_time, 's').astype(np.int64)
+        end_time = None if end_time is None else np.datetime64(end_time, 's').astype(np.int64)
+
+        matches = []
+        for chunk in self.chunks:
+            if article_ids is not None and not ((chunk["min_article_id"] <= article_ids) & (article_ids <= chunk["max_article_id"])).any():
+                continue
+            if start_time is not None and chunk["max_timestamp"] < start_time:
+                continue
+            if end_time is not None and end_time <= chunk["min_timestamp"]:
+                continue
+            matches.append(chunk)
+        return matches
+
+    def query(self, article_ids: list = None, user_ids: list = None, start_time = None, end_time = None, columns: list = None) -> pd.DataFrame:
+        """
+        Get the revisions of some articles, users, and/or time range [start_time, end_time) as a DataFrame with the
+        same columns as `read_revisions`. Only the chunks that the zone maps say can match are read.
+
+        Examples
+        --------
+        >>> store = RevisionStore('/path/to/store')
+        >>> store.query(article_ids=[12, 290], columns=['article_id', 'user_id'])
+        >>> store.query(user_ids=['Koavf'], start_time='2006-01-01', end_time='2007-01-01')
+        """
+        columns = COLUMNS if columns is None else columns
+        frames = []
+
+        for chunk in self.matching_chunks(article_ids, start_time, end_time):
+            start, end = chunk["start"], chunk["end"]
+
+            # Filter on the cheap numeric columns first, and only decode the strings of the rows we keep
+            mask = np.ones(end - start, dtype=bool)
+            if article_ids is not None:
+                mask &= np.isin(self.column("article_id", start, end), list(article_ids))
+            if start_time is not None:
+                mask &= np.datetime64(start_time, 's') <= self.column("timestamp", start, end)
+            if end_time is not None:
+                mask &= self.column("timestamp", start, end) < np.datetime64(end_time, 's')
+            if user_ids is not None:
+                mask &= np.isin(np.array(self.column("user_id", start, end), dtype=object), list(user_ids))
+
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                continue
+
+            frame = {}
+            for column in columns:
+                values = self.column(column, start + rows[0], start + rows[-1] + 1)
+                keep = rows - rows[0]
+                frame[column] = np.asarray(values)[keep] if column in self.meta["numeric_columns"] else [values[i] for i in keep]
+            frames.append(pd.DataFrame(frame, columns=columns))
+
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def parse_revisions(lines) -> pd.DataFrame:
+    """ Parse a chunk of revisions into a DataFrame. Runs in a worker process """
+    return pd.DataFrame([parse_line(line) for line in lines], columns=COLUMNS)
+
+
+if __name__ == "__main__":
+    # One time conversion of the filtered revisions to a store, the bz2 file is parsed in parallel
+    file_path = '/work3/s204163/wiki/wiki-revisions-filtered.bz2'
+    store_path = '/work3/s204163/wiki/revision-store'
+
+    write_revision_store((df for _, df in parallel_scan(file_path, parse_revisions)), store_path)
+    print(RevisionStore(store_path))
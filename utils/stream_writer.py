@@ -0,0 +1,91 @@
+from utils.bz2_blocks import compress_block, MAX_BLOCK_INPUT
+from utils.index_file import save_index_file
+from utils.read_data import ROWS_PER_REVISION
+from utils.create_index import save_block_index_file
+
+STREAM_INDEX_SUFFIX = ".streams"    # The stream index of a file is saved next to it, e.g. wiki-revisions-filtered.bz2.streams
+
+
+def compress_revisions(revisions) -> list:
+    """
+    Compress revisions (the raw text of whole revisions) to bzip2 streams of a single block each, made to be run in
+    worker processes. Streams start at a revision whenever possible, only revisions larger than a block are split.
+    Returns a list of (stream, start_bit, end_bit, n_rows) that can be written with `MultiStreamWriter`
+    """
+    pieces = []
+    data, size = [], 0
+    for revision in revisions:
+        revision = revision.encode("utf-8")
+        if data and MAX_BLOCK_INPUT < size + len(revision):
+            pieces.append(b"".join(data))
+            data, size = [], 0
+        data.append(revision)
+        size += len(revision)
+    if data:
+        pieces.append(b"".join(data))
+
+    streams = []
+    for piece in pieces:
+        for start in range(0, len(piece), MAX_BLOCK_INPUT):
+            block = piece[start:start + MAX_BLOCK_INPUT]
+            streams.append((*compress_block(block), block.count(b"\n")))
+    return streams
+
+
+class MultiStreamWriter:
+    def __init__(self, file, streams: list = None, n_rows: int = 0):
+        """
+        Write independently compressed bzip2 streams (see `compress_revisions`) one after another to a file. The
+        result is a normal multi stream .bz2 file that bzcat, bz2.open etc. read as one, but since we know where every
+        stream and block is as we write them, the block index (and a stream index) come for free and the file can be
+        read randomly and in parallel (see `read_rows_from` and `utils/parallel_scan.py`) as soon as it is written.
+
+        Parameters
+        ----------
+        file : file
+            A binary file opened for writing, at the position to write the first stream
+        streams : list, optional
+            The (byte_offset, start_bit, end_bit, first_row) of every stream written before, e.g. from a checkpoint
+        n_rows : int, optional
+            The number of rows written before
+
+        Examples
+        --------
+        >>> with open('/path/to/output.bz2', 'wb') as file:
+        ...     writer = MultiStreamWriter(file)
+        ...     writer.write(compress_revisions(revisions))
+        >>> writer.save_index('/path/to/output.bz2')
+        """
+        self.file = file
+        self.streams = [tuple(stream) for stream in streams or []]
+        self.n_rows = n_rows
+
+    def __repr__(self):
+        return f"MultiStreamWriter(n_streams={len(self.streams)}, n_rows={self.n_rows})"
+
+    def write(self, streams: list) -> None:
+        """ Append streams to the file and log their position and first row """
+        for stream, start_bit, end_bit, n_rows in streams:
+            byte_offset = self.file.tell()
+            self.file.write(stream)
+            self.streams.append((byte_offset, byte_offset * 8 + start_bit, byte_offset * 8 + end_bit, self.n_rows))
+            self.n_rows += n_rows
+
+    def state(self) -> dict:
+        """ Everything needed to continue writing, can be passed as MultiStreamWriter(file, **state) """
+        return {"streams": self.streams, "n_rows": self.n_rows}
+
+    def save_index(self, file_path: str) -> None:
+        """
+        Save the block index (the same as `create_block_index_file` would make) and the stream index, with the byte
+        offset and the first revision that starts in every stream, next to the file
+        """
+        index = [(start_bit, end_bit, first_row) for _, start_bit, end_bit, first_row in self.streams]
+        end_bit = index[-1][1] if index else 0
+        index.append((end_bit, end_bit, self.n_rows))
+        save_block_index_file(file_path, index)
+
+        save_index_file(f"{file_path}{STREAM_INDEX_SUFFIX}", {
+            "byte_offset"   : [byte_offset for byte_offset, _, _, _ in self.streams],
+            "first_revision": [-(-first_row // ROWS_PER_REVISION) for _, _, _, first_row in self.streams],
+        })
@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+VOCABULARY_SUFFIX = ".vocab"
+DOMAINS = ["user_id", "username", "article_title", "category", "link"]     # The string domains of the revisions
+
+
+class Vocabulary:
+    def __init__(self, strings: list = ()):
+        """
+        A mapping of strings to dense int32 ids (0, 1, 2, ...), given in the order the strings are first seen.
+        The same user ids, titles and categories are repeated millions of times in the revisions, storing
+        them as ids instead of Python strings saves an order of magnitude of memory and allows numpy arrays.
+
+        Parameters
+        ----------
+        strings : list[str], optional
+            Strings to add to the vocabulary from the start
+
+        Examples
+        --------
+        >>> users = Vocabulary()
+        >>> ids = users.encode(['127.0.0.1', 'Koavf', '127.0.0.1']) # --> array([0, 1, 0], dtype=int32)
+        >>> users.decode(ids)                                       # --> ['127.0.0.1', 'Koavf', '127.0.0.1']
+        >>> users.save('/work3/s204163/wiki/vocabularies/user_id.vocab')
+        """
+        self._ids = {}
+        self._strings = []
+        self._decoder = None
+        self.encode(strings)
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __contains__(self, string: str):
+        return string in self._ids
+
+    def __repr__(self):
+        return f"Vocabulary(n_strings={len(self)})"
+
+    def encode(self, strings, add: bool = True) -> np.ndarray:
+        """
+        Get the ids of many strings at once. New strings are added to the vocabulary, unless `add` is False
+        in which case they get the id -1. Every distinct string is only looked up once.
+        """
+        codes, uniques = pd.factorize(np.array(list(strings), dtype=object))
+
+        unique_ids = np.empty(len(uniques), dtype=np.int32)
+        for i, string in enumerate(uniques):
+            id = self._ids.get(string)
+            if id is None and add:
+                id = self._ids[string] = len(self._strings)
+                self._strings.append(string)
+                self._decoder = None
+            unique_ids[i] = -1 if id is None else id
+
+        return unique_ids[codes]
+
+    def decode(self, ids) -> list:
+        """ Get the strings of many ids at once """
+        if self._decoder is None:
+            self._decoder = np.array(self._strings, dtype=object)
+        return self._decoder[np.asarray(ids, dtype=np.int64)].tolist()
+
+    def save(self, file_path: str) -> None:
+        """ Save the strings in id order, one per line. None of the domains have strings with newlines in them """
+        with open(file_path, 'w', encoding="utf-8", newline="\n") as file:
+            file.writelines(f"{string}\n" for string in self._strings)
+
+    @classmethod
+    def load(cls, file_path: str) -> "Vocabulary":
+        """ Load a vocabulary saved with `save`, the ids are the same as when it was saved """
+        with open(file_path, 'r', encoding="utf-8", newline="\n") as file:
+            return cls(file.read().split("\n")[:-1])
+
+
+def load_vocabularies(directory: str, domains: list = DOMAINS) -> dict:
+    """ Load the vocabulary of every domain saved in the directory, domains that havent been saved yet start empty """
+    vocabularies = {}
+    for domain in domains:
+        file_path = os.path.join(directory, f"{domain}{VOCABULARY_SUFFIX}")
+        vocabularies[domain] = Vocabulary.load(file_path) if os.path.exists(file_path) else Vocabulary()
+    return vocabularies
+
+
+def save_vocabularies(directory: str, vocabularies: dict) -> None:
+    """ Save a dictionary of domain : vocabulary, e.g. next to the data they were made from """
+    os.makedirs(directory, exist_ok=True)
+    for domain, vocabulary in vocabularies.items():
+        vocabulary.save(os.path.join(directory, f"{domain}{VOCABULARY_SUFFIX}"))